@@ -0,0 +1,365 @@
+'''
+functions that benchmark the functions package on synthetic data shaped like the real data, 
+run as a script to print the results as json:
+
+    python functions/benchmark_functions.py imports inference pseudoinverse genes death_prediction
+'''
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+
+FUNCTIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# modules of the functions package, and the heavy dependencies that shouldn't be loaded by importing them
+PACKAGE_MODULES = ['pseudoinverse_functions', 'gene_analysis_functions', 'death_prediction_functions', 'data_loading_functions', 
+                   'inference_functions']
+HEAVY_MODULES = ['torch', 'selenium', 'webdriver_manager', 'bs4', 'requests', 'liftover', 'matplotlib', 'ipywidgets', 'statsmodels']
+
+def benchmark_imports(modules=PACKAGE_MODULES, repeats=5):
+    '''
+    times the import of each module in a fresh interpreter, so that nothing is already cached in sys.modules
+
+        param modules: names of the modules to import, list
+        param repeats: number of fresh interpreters per module, the median time is reported, int
+
+        return: by module, the median import time (s) and the heavy dependencies it loaded, dict
+    '''
+
+    # imports the module, then reports the time and which heavy modules ended up in sys.modules
+    script = (
+        'import sys, time, json\n'
+        'sys.path.insert(0, {path!r})\n'
+        'start = time.perf_counter()\n'
+        'import {module}\n'
+        'elapsed = time.perf_counter() - start\n'
+        'print(json.dumps([elapsed, [name for name in {heavy!r} if name in sys.modules]]))\n'
+    )
+
+    results = {}
+    for module in modules:
+        times = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', script.format(path=FUNCTIONS_DIR, module=module, heavy=HEAVY_MODULES)],
+                                    capture_output=True, text=True)
+            if output.returncode != 0: # e.g. a dependency that isn't installed
+                results[module] = {'error': output.stderr.strip().splitlines()[-1]}
+                break
+            elapsed, loaded = json.loads(output.stdout)
+            times.append(elapsed)
+        else:
+            results[module] = {'seconds': float(np.median(times)), 'heavy_modules_loaded': loaded}
+
+    return results
+
+def benchmark_inference(n_rows=200000, n_inputs=9, chunk_sizes=[1024, 16384, 131072], repeats=3):
+    '''
+    times scoring with an exported model streamed from disk against eager generate_nn_pred on the full input,
+    on random inputs with an untrained model
+
+        param n_rows: number of input rows, int
+        param n_inputs: number of input columns, int
+        param chunk_sizes: numbers of rows scored at once, list
+        param repeats: number of runs per setting, the median is reported, int
+
+        return: throughput (rows/s) of each setting, and the median and 95th percentile latency (ms) of one chunk, dict
+    '''
+    sys.path.insert(0, FUNCTIONS_DIR)
+    import pandas as pd
+    import torch
+    from death_prediction_functions import model_class, generate_nn_pred
+    from inference_functions import export_model, load_model, score, iter_input_chunks
+
+    torch.manual_seed(0)
+    model = model_class()(n_inputs)
+    values = np.random.default_rng(0).normal(size=(n_rows, n_inputs)).astype('float32')
+    data = pd.DataFrame(values)
+
+    results = {'n_rows': n_rows, 'torch_threads': torch.get_num_threads()}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'inputs.npy')
+        model_path = os.path.join(tmp_dir, 'model.pt')
+        np.save(input_path, values)
+
+        start = time.perf_counter()
+        export_model(model, model_path)
+        results['export_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        exported, _ = load_model(model_path)
+        results['load_seconds'] = time.perf_counter() - start
+
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            generate_nn_pred(model, data)
+            times.append(time.perf_counter() - start)
+        results['eager_full'] = {'rows_per_second': n_rows/float(np.median(times))}
+
+        for chunk_size in chunk_sizes:
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                score(exported, input_path, chunk_size=chunk_size, out_path=os.path.join(tmp_dir, 'predictions.npy'))
+                times.append(time.perf_counter() - start)
+
+            # latency of scoring a single chunk, once it has been read
+            latencies = []
+            with torch.inference_mode():
+                for chunk in iter_input_chunks(input_path, chunk_size=chunk_size):
+                    start = time.perf_counter()
+                    exported(torch.from_numpy(chunk))
+                    latencies.append(time.perf_counter() - start)
+
+            results[f'exported_chunk_{chunk_size}'] = {
+                'rows_per_second': n_rows/float(np.median(times)),
+                'latency_ms_median': 1000*float(np.median(latencies)),
+                'latency_ms_p95': 1000*float(np.percentile(latencies, 95)),
+            }
+
+    return results
+
+# trait name prefixes, as used by timepoint_rank
+TIMEPOINTS = ['M16', 'M14', 'M12', 'M10', 'M8', 'M6', 'w20', 'w18', 'w16', 'w15', 'w14', 'w13', 'w12']
+
+def synthetic_methylation(n_animals=47, n_probes=10000, n_traits=55, seed=0):
+    '''
+    generates trait and methylation data shaped like load_methylation_phenotype's, 
+    the probes and half of the traits share a few latent factors, so that those traits are predictable from the probes
+
+        param n_animals: number of animals, int
+        param n_probes: number of methylation probes, int
+        param n_traits: number of traits, including Rank and the two strain traits, int
+        param seed: random seed, int
+
+        return: trait data (m = traits, n = animals) and methylation data (m = probe ID, n = animals), dfs
+    '''
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    animals = [str(600 + i) for i in range(n_animals)]
+    latent = rng.normal(size=(5, n_animals))
+
+    trait_names = ['Rank', 'CD1 or C57BL6J?', 'C57BL6J or Sv129Ev?']
+    trait_names += [f'{TIMEPOINTS[i % len(TIMEPOINTS)]}_trait_{i}' for i in range(n_traits - 3)]
+    loadings = rng.normal(size=(n_traits, 5))
+    loadings[1::2] = 0 # unpredictable, so that pinv_dropmin drops them
+    trait_vals = loadings @ latent + rng.normal(size=(n_traits, n_animals))
+    trait_vals[:3] = rng.integers(0, 3, size=(3, n_animals)) # categorical, as rank and strain are
+    trait_data = pd.DataFrame(trait_vals, index=trait_names, columns=animals)
+
+    # beta values, between 0 and 1
+    # a fifth of the probes track the latent factors closely, so that filter_meth keeps some
+    scale = np.where(rng.random((n_probes, 1)) < 0.2, 3, 0.3)
+    meth_vals = scale*rng.normal(size=(n_probes, 5)) @ latent + rng.normal(size=(n_probes, n_animals)) + rng.normal(size=(n_probes, 1))
+    meth_data = pd.DataFrame(1/(1 + np.exp(-meth_vals)), index=[f'cg{i:08d}_TC11' for i in range(n_probes)], columns=animals)
+
+    return trait_data, meth_data
+
+def synthetic_cohort(n_subjects=300, max_time_points=15, seed=0):
+    '''
+    generates a longitudinal subject table shaped like the death prediction model's inputs, 
+    each subject's rows are consecutive and start at a time_point_in_study_weeks of 0
+
+        param n_subjects: number of subjects, int
+        param max_time_points: most time points per subject, int
+        param seed: random seed, int
+
+        return: input values, df, and time until death (weeks), series
+    '''
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    n_points = rng.integers(3, max_time_points + 1, size=n_subjects)
+    subject = np.repeat(np.arange(n_subjects), n_points)
+    time_point = 4*np.concatenate([np.arange(n) for n in n_points])
+
+    X = pd.DataFrame(rng.normal(size=(len(subject), 6)) + rng.normal(size=(n_subjects, 6))[subject], 
+                     columns=[f'phenotype_{i}' for i in range(6)])
+    X['time_point_in_study_weeks'] = time_point
+    strain = rng.integers(0, 3, size=n_subjects)[subject]
+    X['C57BL6J or Sv129Ev'] = (strain != 0).astype(int)
+    X['CD1 or C57BL6J'] = (strain != 2).astype(int)
+    X['Rank'] = rng.integers(1, 4, size=n_subjects)[subject]
+
+    death = 4*n_points[subject] + rng.integers(0, 30, size=n_subjects)[subject]
+    y = pd.Series((death - time_point + 2*X['phenotype_0']).clip(lower=0).astype(float))
+
+    return X.astype(float), y
+
+def synthetic_positions(n_probes=10000, n_chroms=5, seed=0):
+    '''
+    generates a probe manifest for get_pos, with some undefined positions
+
+        param n_probes: number of probes, int
+        param n_chroms: number of chromosomes, int
+        param seed: random seed, int
+
+        return: probe data and reference data (chr and start by probe), dfs
+    '''
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    probes = [f'cg{i:08d}_TC11' for i in range(n_probes)]
+    ref_data = pd.DataFrame({'chr': [f'chr{c}' for c in rng.integers(1, n_chroms + 1, size=n_probes)], 
+                             'start': rng.integers(1, 10**7, size=n_probes).astype(str)}, index=probes)
+    ref_data.loc[rng.random(n_probes) < 0.05, ['chr', 'start']] = 'nan'
+    probe_data = pd.DataFrame({'coef': rng.normal(size=n_probes)}, index=probes)
+
+    return probe_data, ref_data
+
+def synthetic_chain(path, n_chroms=5, chrom_size=10**7, block_size=10**5, gap=1000):
+    '''
+    writes a chain file for get_pos, where every chromosome is aligned in blocks separated by unaligned gaps
+
+        param path: path of the chain file, str
+        param n_chroms: number of chromosomes, int
+        param chrom_size: size of each chromosome, int
+        param block_size: size of each aligned block, int
+        param gap: size of the gaps, int
+
+        return: none
+    '''
+
+    n_blocks = chrom_size//(block_size + gap)
+    with open(path, 'w') as file:
+        for c in range(1, n_chroms + 1):
+            t_end = n_blocks*block_size + (n_blocks - 1)*gap
+            q_end = n_blocks*block_size + (n_blocks - 1)*2*gap
+            file.write(f'chain 1000 chr{c} {chrom_size} + 0 {t_end} chr{c} {chrom_size + n_blocks*gap} + 0 {q_end} {c}\n')
+            for _ in range(n_blocks - 1):
+                file.write(f'{block_size} {gap} {2*gap}\n')
+            file.write(f'{block_size}\n\n')
+
+    return
+
+def measure(run, repeats=3):
+    '''
+    times a function, then runs it once more to get the peak memory allocated while it runs, 
+    as tracked by tracemalloc, so numpy and pandas allocations are included but e.g. torch's aren't, 
+    warnings are silenced, since e.g. constant synthetic traits would repeat them for every run
+
+        param run: the function, called without arguments, function
+        param repeats: number of timed runs, the median is reported, int
+
+        return: median time (s) and peak memory (MB), dict
+    '''
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {'seconds': float(np.median(times)), 'peak_mb': peak/2**20}
+
+def benchmark_pseudoinverse(n_animals=[25, 47], n_probes=[1000, 5000, 20000], repeats=1):
+    '''
+    times pinv_iteration, pinv_dropmin, meth_calc and quality_filter on synthetic data, for every number of animals and probes
+
+        param n_animals: numbers of animals, list
+        param n_probes: numbers of probes, list
+        param repeats: number of timed runs per setting, int
+
+        return: one record per function and setting, list of dicts
+    '''
+    sys.path.insert(0, FUNCTIONS_DIR)
+    from pseudoinverse_functions import pinv_iteration, pinv_dropmin, meth_calc, quality_filter
+    import scipy.stats, statsmodels.api # imported up front, so that the first run doesn't include their import time
+
+    results = []
+    for animals in n_animals:
+        for probes in n_probes:
+            trait_data, meth_data = synthetic_methylation(n_animals=animals, n_probes=probes)
+            runs = {
+                'pinv_iteration': lambda: pinv_iteration(trait_data, meth_data),
+                'pinv_dropmin': lambda: pinv_dropmin(trait_data, meth_data, 0.6, probe_thresh=0.5),
+                'meth_calc': lambda: meth_calc(trait_data, meth_data),
+                'quality_filter': lambda: quality_filter(trait_data, 0.7),
+            }
+            for name, run in runs.items():
+                results.append({'function': name, 'n_animals': animals, 'n_probes': probes, **measure(run, repeats)})
+
+    return results
+
+def benchmark_genes(n_probes=[10000, 100000], repeats=3):
+    '''
+    times get_pos (bulk, through a synthetic chain file) on a synthetic probe manifest, for every number of probes
+
+        param n_probes: numbers of probes, list
+        param repeats: number of timed runs per setting, int
+
+        return: one record per setting, list of dicts
+    '''
+    sys.path.insert(0, FUNCTIONS_DIR)
+    from gene_analysis_functions import get_pos
+    import liftover # imported up front, so that the first run doesn't include its import time
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chain_path = os.path.join(tmp_dir, 'synthetic.chain')
+        synthetic_chain(chain_path)
+        for probes in n_probes:
+            probe_data, ref_data = synthetic_positions(n_probes=probes)
+            run = lambda: get_pos(probe_data.copy(), ref_data, bulk=True, chain_path=chain_path)
+            results.append({'function': 'get_pos', 'n_probes': probes, **measure(run, repeats)})
+
+    return results
+
+def benchmark_death_prediction(n_subjects=[50, 150], batch_size=32, n_iterations=3, repeats=1):
+    '''
+    times train_nn and cross_validation on synthetic longitudinal cohorts, for every number of subjects
+
+        param n_subjects: numbers of subjects, list
+        param batch_size: batch size for training, int
+        param n_iterations: number of cross validation iterations, int
+        param repeats: number of timed runs per setting, int
+
+        return: one record per function and setting, list of dicts
+    '''
+    sys.path.insert(0, FUNCTIONS_DIR)
+    from death_prediction_functions import train_nn, cross_validation
+
+    # a small fit up front, so that the first run doesn't include the imports and torch's one-time setup
+    with contextlib.redirect_stdout(io.StringIO()):
+        train_nn(*synthetic_cohort(n_subjects=5), batch_size, print_epochs=False, print_every=0)
+
+    results = []
+    for subjects in n_subjects:
+        X, y = synthetic_cohort(n_subjects=subjects)
+        runs = {
+            'train_nn': lambda: train_nn(X, y, batch_size, print_epochs=False, print_every=0),
+            'cross_validation': lambda: cross_validation(X, y, batch_size, n_iterations),
+        }
+        for name, run in runs.items():
+            with contextlib.redirect_stdout(io.StringIO()): # the progress bars and losses would mix with the json
+                record = measure(run, repeats)
+            results.append({'function': name, 'n_subjects': subjects, 'n_rows': X.shape[0], **record})
+
+    return results
+
+if __name__ == '__main__':
+    benchmarks = {'imports': benchmark_imports, 'inference': benchmark_inference, 'pseudoinverse': benchmark_pseudoinverse, 
+                  'genes': benchmark_genes, 'death_prediction': benchmark_death_prediction}
+
+    names = sys.argv[1:] or list(benchmarks)
+    print(json.dumps({name: benchmarks[name]() for name in names}, indent=2))
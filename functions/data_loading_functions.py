@@ -0,0 +1,201 @@
+'''
+functions that load the raw data, caching it in a binary layout so that it only has to be parsed once,
+and the file helpers shared by the analysis and inference modules (.npy outputs, file hashes, cache eviction)
+'''
+import numpy as np
+import pandas as pd
+
+import hashlib
+import json
+import os
+import shutil
+
+
+def load_methylation_phenotype(path='methylation_phenotype_encoded.xlsx', sep=55, cache_dir=None, mmap=True):
+    '''
+    loads the methylation-phenotype data, split into trait and methylation data as in the notebooks,
+    i.e. pd.read_excel(path, index_col=0).dropna(), then data[:sep] and data[sep:]
+
+    the first call parses the source and writes trait.npy (float64), meth.npy (float32), labels.pkl and index.json to cache_dir,
+    later calls load these directly; the cache is rebuilt when the source size/mtime and hash no longer match
+
+        param path: path of the source data, .xlsx or .csv, str
+        param sep: the point in the data where methylation and phenotype data diverge, int
+        param cache_dir: directory for the cached arrays, if None '<source name>_cache' next to the source, str
+        param mmap: whether to memory map the methylation data rather than reading it into memory, bool
+
+        return: trait data (m = traits, n = animals) and methylation data (m = probe ID, n = animals), dfs
+    '''
+
+    if cache_dir is None:
+        cache_dir = os.path.splitext(path)[0] + '_cache'
+
+    index = read_cache_index(path, cache_dir, sep)
+    if index is None: # parse the source and (re)build the cache
+        index = build_cache(path, cache_dir, sep)
+
+    trait_vals = np.load(os.path.join(cache_dir, 'trait.npy'))
+    meth_vals = np.load(os.path.join(cache_dir, 'meth.npy'), mmap_mode='r' if mmap else None)
+    labels = pd.read_pickle(os.path.join(cache_dir, 'labels.pkl'))
+
+    trait_data = pd.DataFrame(trait_vals, index=labels['traits'], columns=labels['animals'])
+    meth_data = pd.DataFrame(meth_vals, index=labels['probes'], columns=labels['animals'], copy=False)
+
+    return trait_data, meth_data
+
+def build_cache(path, cache_dir, sep=55):
+    '''
+    parses the source data and writes the cached arrays used by load_methylation_phenotype
+
+        param path: path of the source data, .xlsx or .csv, str
+        param cache_dir: directory for the cached arrays, str
+        param sep: the point in the data where methylation and phenotype data diverge, int
+
+        return: the cache index, dict
+    '''
+
+    if path.endswith('.csv'):
+        data = pd.read_csv(path, index_col=0)
+    else:
+        data = pd.read_excel(path, index_col=0)
+    data = data.dropna()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    if os.path.exists(index_path): # the index marks a complete cache, so remove it before overwriting the arrays
+        os.remove(index_path)
+
+    np.save(os.path.join(cache_dir, 'trait.npy'), data.iloc[:sep].values.astype('float64'))
+    np.save(os.path.join(cache_dir, 'meth.npy'), data.iloc[sep:].values.astype('float32'))
+
+    # pickled rather than stored in the index, so that labels json can't store (e.g. dates) keep their type
+    labels = {'traits': data.index[:sep], 'probes': data.index[sep:], 'animals': data.columns}
+    pd.to_pickle(labels, os.path.join(cache_dir, 'labels.pkl'))
+
+    stat = os.stat(path)
+    index = {
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime,
+        'source_hash': file_hash(path),
+        'sep': sep,
+    }
+
+    # written last, so an interrupted build is never mistaken for a valid cache
+    with open(index_path, 'w') as file:
+        json.dump(index, file)
+
+    return index
+
+def read_cache_index(path, cache_dir, sep=55):
+    '''
+    reads the cache index, if it is still valid for the source data
+
+        param path: path of the source data, str
+        param cache_dir: directory for the cached arrays, str
+        param sep: the point in the data where methylation and phenotype data diverge, int
+
+        return: the cache index, dict, or None if there is no valid cache
+    '''
+
+    index_path = os.path.join(cache_dir, 'index.json')
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path) as file:
+        index = json.load(file)
+
+    if (index['sep'] != sep) or ('traits' in index): # caches from before labels.pkl store the labels as strings
+        return None
+
+    stat = os.stat(path)
+    if (index['source_size'] == stat.st_size) and (index['source_mtime'] == stat.st_mtime):
+        return index
+
+    # the file was touched, so only rebuild if its contents changed
+    if (index['source_size'] != stat.st_size) or (index['source_hash'] != file_hash(path)):
+        return None
+
+    index['source_mtime'] = stat.st_mtime
+    with open(index_path, 'w') as file:
+        json.dump(index, file)
+
+    return index
+
+def file_hash(path, chunk_size=2**20):
+    '''
+    gets the sha256 hash of a file, read in chunks
+
+        param path: path of the file, str
+        param chunk_size: number of bytes read at once, int
+
+        return: hex digest, str
+    '''
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def evict_lru(cache_dir, max_bytes, exts, keep=None):
+    '''
+    removes the least recently used entries of a cache directory until it is within max_bytes, 
+    where an entry is every file with the same name and one of exts, last used at the latest modification time of its files
+
+        param cache_dir: cache directory, str
+        param max_bytes: the largest the cache can be, in bytes, int
+        param exts: extensions of the cached files, e.g. ('.json', '.png'), tuple
+        param keep: name (without extension) of an entry that is never removed, e.g. the one just stored, str
+
+        return: number of entries removed, int
+    '''
+
+    # group the files by entry, then evict the oldest entries
+    entries = {}
+    for name in os.listdir(cache_dir):
+        entry, ext = os.path.splitext(name)
+        if ext not in exts:
+            continue
+        stat = os.stat(os.path.join(cache_dir, name))
+        size, last_used = entries.get(entry, (0, 0))
+        entries[entry] = (size + stat.st_size, max(last_used, stat.st_mtime))
+
+    total = sum(size for size, _ in entries.values())
+    removed = 0
+    for entry, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        if entry == keep:
+            continue
+        for ext in exts:
+            path = os.path.join(cache_dir, entry + ext)
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+        removed += 1
+
+    return removed
+
+def raw_to_npy(raw_path, npy_path, n_cols, dtype='float32'):
+    '''
+    converts a headerless binary file, written block by block, into a .npy file, then removes the raw file
+
+        param raw_path: path of the raw file, str
+        param npy_path: path of the .npy file to create, str
+        param n_cols: number of columns per row, int
+        param dtype: data type of the raw values, str
+
+        return: none
+    '''
+
+    dtype = np.dtype(dtype)
+    n_rows = os.path.getsize(raw_path) // (dtype.itemsize * max(n_cols, 1))
+
+    with open(npy_path, 'wb') as npy_file, open(raw_path, 'rb') as raw_file:
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (n_rows, n_cols)}
+        np.lib.format.write_array_header_1_0(npy_file, header)
+        shutil.copyfileobj(raw_file, npy_file) # copied in chunks, so memory doesn't depend on file size
+
+    os.remove(raw_path)
+    return
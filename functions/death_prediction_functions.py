@@ -1,39 +1,61 @@
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import DataLoader, TensorDataset
 import copy
 import pandas as pd
 import numpy as np
-from ipywidgets import IntProgress
-from IPython.display import display
 import random
+import warnings
 
 '''
 Functions utilized in the death prediction model
 
 Note that this isn't optimized for CUDA
+torch, ipywidgets and sklearn are imported by the functions that use them, so that e.g. time_to_death_grouped doesn't need them
 '''
 
-class Model(nn.Module):
-  def __init__(self, n_inputs=9, h1=70, h2=70, out_features=1):
-    super().__init__()
-    self.fc1 = nn.Linear(n_inputs, h1)
-    self.fc2 = nn.Linear(h1, h2)
-    self.out = nn.Linear(h2, out_features)
+# classes that require torch, defined on first use
+lazy_classes = {}
 
-  def forward(self, x):
-    x = F.relu(self.fc1(x))
-    x = F.relu(self.fc2(x))
-    x = self.out(x)
+def model_class():
+  '''
+  Returns the Model class, importing torch and defining it on the first call
+  '''
+
+  if 'Model' not in lazy_classes:
+    import torch.nn as nn
+    import torch.nn.functional as F
+
+    class Model(nn.Module):
+      def __init__(self, n_inputs=9, h1=70, h2=70, out_features=1):
+        super().__init__()
+        self.fc1 = nn.Linear(n_inputs, h1)
+        self.fc2 = nn.Linear(h1, h2)
+        self.out = nn.Linear(h2, out_features)
+
+      def forward(self, x):
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        x = self.out(x)
+
+        return x
+
+    Model.__qualname__ = 'Model' # so that pickled models are found through the module attribute
+    lazy_classes['Model'] = Model
 
-    return x
+  return lazy_classes['Model']
+
+def __getattr__(name):
+  '''
+  Makes Model available as a module attribute, e.g. from death_prediction_functions import Model
+  '''
+  if name == 'Model':
+    return model_class()
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
   
 
 def set_seed(seed):
     '''
     Sets a specific random seed to make results consistent
     '''
+    import torch
 
     random.seed(seed)
     np.random.seed(seed)
@@ -67,7 +89,8 @@ def time_to_death_grouped(data, category):
     
     return grouped_data
 
-def cross_validation(X, y, batch_size, n_iterations, scramble_trait=False, remove_trait=False):
+def cross_validation(X, y, batch_size, n_iterations, scramble_trait=False, remove_trait=False, ensemble=False, n_jobs=1, torch_threads=1, seed=808, 
+                     n_repeats=1, importance=False, confidence=0.95, train_options=None):
   '''
   runs cross validation to determine loss of neural network model
     param X: all input values, df
@@ -76,15 +99,35 @@ def cross_validation(X, y, batch_size, n_iterations, scramble_trait=False, remov
     param n_iterations: number of entries within cross validation, int
     param scramble_trait: whether to test the accuracy of the model with scrambled inputs by parameter during testing
     param remove_trait: whether to test the accuracy of the model with removed parameters during training
-    return: 3 lists containing all of the models predictions, the actual values, and the loss values
+    param ensemble: whether to train all of the models (every fold, and every removed trait variant) at once with train_ensemble
+    param n_jobs: if more than 1, the number of worker processes that train the models up front with train_pool, int
+      each spawned worker imports torch, which takes seconds, so this only pays off when the models take longer than that to train
+    param torch_threads: number of torch threads per worker process, int
+    param seed: random seed for the folds, set by each model's training, and with seed + iteration, for the scramble_trait noise,
+      so that the results don't depend on n_jobs (ensemble models match train_nn to about 1e-3), int
+    param n_repeats: with scramble_trait, number of noise draws per scrambled trait and iteration, int
+    param importance: with scramble_trait, whether to return the importance of each trait with confidence intervals 
+      (see importance_summary) rather than the average loss, bool
+    param confidence: confidence level of the intervals, float
+    param train_options: further arguments of train_nn, e.g. {'patience': 10, 'lr_decay': 0.5}, not supported with ensemble, dict
+    return: 3 arrays containing all of the models predictions, the actual values, and the loss values, 
+      or with scramble_trait/remove_trait the average loss by trait, dict, or with importance the importance by trait, df
   '''
+  from ipywidgets import IntProgress
+  from IPython.display import display
+
+  if train_options is None:
+    train_options = {}
+  elif ensemble:
+    raise ValueError('train_options are not supported by train_ensemble')
 
   # set random seed
-  set_seed(808) # arbitrary
+  set_seed(seed)
 
   # get the data structures to return
   if (scramble_trait or remove_trait):
     trait_loss = {}
+    draws = []
   else:
     all_approx = []
     all_actual = []
@@ -94,139 +137,97 @@ def cross_validation(X, y, batch_size, n_iterations, scramble_trait=False, remov
   progress_bar = IntProgress(min=0, max=n_iterations, description=f'Training')
   display(progress_bar)
 
-  # create a dictionary distinguishing the different subjects
-  subj_indices = {}
-
-  # get the indices distinguishing each individual subject and add them to a list
-  working_subject = []
-  n_subjects = 0
-
-  # iterate over each row in the DataFrame
-  for i, row in X.iterrows():
-      # check if the time point is 0
-      if row['time_point_in_study_weeks'] == 0:
-          if i > 0:
-              # append the index of the previous row (end of the previous subject)
-              working_subject.append(i - 1)
-              # add the start index of the current subject (the current index)
-              subj_indices[f'subject_{n_subjects}'] = [working_subject[0], i - 1]
-              # prepare for the next subject
-              working_subject = [i]  # start new subject with the current index
-              n_subjects += 1
-          else:
-              # this handles the case for the very first subject
-              working_subject.append(i)
-
-  # add the last subject manually, using only the first and last index
-  if working_subject:
-      subj_indices[f'subject_{n_subjects}'] = [working_subject[0], X.index[-1]]
-
-  # split the dictionary into [n_iterations] subsets
-  subjects = list(subj_indices.keys())
+  # get the subject of every row, and split the subjects into [n_iterations] subsets
+  row_subjects = subject_index(X['time_point_in_study_weeks'].values)
+  subjects = list(range(row_subjects.max() + 1))
   random.shuffle(subjects)
   sample_pool = [subjects[i::n_iterations] for i in range(n_iterations)]
-  
-  n = 0
-  while n < n_iterations:
 
-    # set the train and test set indices depending on which iteration you are on
-    train_subj = [subj_indices[item] for i, sublist in enumerate(sample_pool) if i != n for item in sublist]
-    test_subj = [subj_indices[item] for item in sample_pool[n]]
+  # the rows in the order that their subjects are concatenated in, i.e. by subset then shuffled subject, and the subset of each
+  subject_fold = np.empty(len(subjects), dtype=int)
+  subject_rank = np.empty(len(subjects), dtype=int)
+  for i, sublist in enumerate(sample_pool):
+    subject_fold[sublist] = i
+  subject_rank[[subject for sublist in sample_pool for subject in sublist]] = np.arange(len(subjects))
+  order = np.argsort(subject_rank[row_subjects], kind='stable')
+  row_fold = subject_fold[row_subjects][order]
+  y_values = np.asarray(y)
 
-    # create new dataframes in accordance with the train indices
-    X_train = pd.concat([X.iloc[start:end+1] for start, end in train_subj], ignore_index=True)
-    y_train = pd.concat([pd.Series(y[start:end+1]) for start, end in train_subj], ignore_index=True)
+  folds = []
+  for n in range(n_iterations):
 
-    #print(X_train.shape)
+    # set the train and test set indices depending on which iteration you are on
+    train_rows = order[row_fold != n]
+    test_rows = order[row_fold == n]
+
+    X_train = X.iloc[train_rows].reset_index(drop=True)
+    y_train = pd.Series(y_values[train_rows])
+    X_test = X.iloc[test_rows].reset_index(drop=True)
+    y_test = pd.Series(y_values[test_rows])
+
+    folds.append((X_train, y_train, X_test, y_test))
+
+  pretrained = ensemble or (n_jobs > 1)
+  if pretrained: # train every model up front, keyed by iteration and removed traits
+    if remove_trait:
+      keys = [(n, label) for n in range(n_iterations) for label, _ in ablation_variants(X.columns)]
+      X_trains = [folds[n][0].drop(columns=removed) for n in range(n_iterations) for _, removed in ablation_variants(X.columns)]
+    else:
+      keys = [(n, None) for n in range(n_iterations)]
+      X_trains = [fold[0] for fold in folds]
+    y_trains = [folds[n][1] for n, _ in keys]
+
+    if ensemble: trained = train_ensemble(X_trains, y_trains, batch_size, seed=seed)
+    else: trained = train_pool(X_trains, y_trains, batch_size, n_jobs=n_jobs, torch_threads=torch_threads, seed=seed, train_options=train_options)
+    models = dict(zip(keys, trained))
+
+  n = 0
+  while n < n_iterations:
 
-    # create new dataframes in accordance with the test indices
-    X_test = pd.concat([X.iloc[start:end+1] for start, end in test_subj], ignore_index=True)
-    y_test = pd.concat([pd.Series(y[start:end+1]) for start, end in test_subj], ignore_index=True)
+    X_train, y_train, X_test, y_test = folds[n]
 
     if scramble_trait: # scramble traits to determine their significance in the model
-      model = train_nn(X_train, y_train, batch_size, bar=False)
-      status = 'with_time'
-      while True:
-        for column in X_test.columns:
-          if status == 'with_time': 
-              working_data = X_test.copy()
-          else: 
-              working_data = X_test.copy()
-              working_data['time_point_in_study_weeks'] = np.random.normal(loc=0, scale=1, size=X_test.shape[0])
-              if column == 'time_point_in_study_weeks': continue
-          # shuffle the target columns
-          if column == 'C57BL6J or Sv129Ev': continue
-          elif column == 'CD1 or C57BL6J':
-              # apply noise to both strain columns
-              working_data['CD1 or C57BL6J'] = np.random.normal(loc=0, scale=1, size=X_test.shape[0])
-              working_data['C57BL6J or Sv129Ev'] = np.random.normal(loc=0, scale=1, size=X_test.shape[0])
-              column = 'Strain'
-          else:
-              working_data[column] = np.random.normal(loc=0, scale=1, size=X_test.shape[0])
-          # get the losses and add them to a trait/iteration specific dictionary
-          losses, _, _ = test_nn(model, working_data, y_test, avg=False)
-          if f'{column}_{status}' not in trait_loss:
-            trait_loss[f'{column}_{status}'] = losses
-          else:
-            trait_loss[f'{column}_{status}'].extend(losses)
-          # tell the loop to remove timepoint from now on, of if its already being removed to break out of the loop
-        if status != 'no_time': status = 'no_time'
-        else: break
+      model = models[(n, None)] if pretrained else train_nn(X_train, y_train, batch_size, bar=False, seed=seed, **train_options)
+      report_stop(model, n)
+      # evaluate every scrambled variant at once, then add the losses to a trait/iteration specific dictionary
+      labels, losses, baseline = scramble_losses(model, X_test, y_test, n_repeats=n_repeats, rng=np.random.default_rng(seed + n))
+      for label, label_losses in zip(labels, losses.transpose(1, 0, 2)):
+        if label not in trait_loss:
+          trait_loss[label] = list(label_losses.ravel())
+        else:
+          trait_loss[label].extend(label_losses.ravel())
+      # increase in the mean loss for each repeat
+      draws.append(losses.mean(axis=2) - baseline.mean())
 
     elif remove_trait:
-      train_iter = X_train.copy()
-      test_iter = X_test.copy()
-      status = 'with_time'
-      while True:
-        for column in X:
-          # indicate the current trait
-          if status == 'with_time': # if time is removed or not
-             pass #print(f'\nremoved trait: {column}') 
-          else: 
-             #print(f'\nremoved traits: {column} and timepoint') 
-             if column == 'time_point_in_study_weeks': continue # if time is removed, and time is slated to be removed, skip this iteration
-             else: pass
-          # check the strain, we want to remove both at once
-          if 'C57BL6J or Sv129Ev' in column:
-             continue
-          elif 'CD1 or C57BL6J' in column:
-             X_train_rm = train_iter.drop(columns = [column, 'C57BL6J or Sv129Ev'])
-             X_test_rm = test_iter.drop(columns = [column, 'C57BL6J or Sv129Ev'])
-             column = 'Strain'
-          else:
-             X_train_rm = train_iter.drop(columns = [column])
-             X_test_rm = test_iter.drop(columns = [column])
-          # train and test the model
-          model = train_nn(X_train_rm, y_train, batch_size, bar=False, print_epochs=False, print_every=0)
-          losses, _, _= test_nn(model, X_test_rm, y_test, avg=False)
-          print(f'{column}_{status} iteration {n} Loss: {np.mean(losses)}')
-          # calculate average loss by trait
-          if f'{column}_{status}' not in trait_loss:
-            trait_loss[f'{column}_{status}'] = losses
-          else:
-            trait_loss[f'{column}_{status}'].extend(losses)
-        if status == 'no_time':
-          break
-        else: # repeat with time removed
-          status = 'no_time'
-          train_iter = X_train.drop(columns = 'time_point_in_study_weeks')
-          test_iter = X_test.drop(columns = 'time_point_in_study_weeks')
+      for label, removed in ablation_variants(X.columns):
+        X_train_rm = X_train.drop(columns = removed)
+        X_test_rm = X_test.drop(columns = removed)
+        # train and test the model
+        if pretrained: model = models[(n, label)]
+        else: model = train_nn(X_train_rm, y_train, batch_size, bar=False, print_epochs=False, print_every=0, seed=seed, **train_options)
+        losses, _, _= test_nn(model, X_test_rm, y_test, avg=False)
+        print(f'{label} iteration {n} Loss: {np.mean(losses)}')
+        report_stop(model, n, label)
+        # calculate average loss by trait
+        if label not in trait_loss:
+          trait_loss[label] = list(losses)
+        else:
+          trait_loss[label].extend(losses)
 
     else: # add the losses and values to their respective lists
-      model = train_nn(X_train, y_train, batch_size, bar=False)
+      model = models[(n, None)] if pretrained else train_nn(X_train, y_train, batch_size, bar=False, seed=seed, **train_options)
+      report_stop(model, n)
       losses, approx, actual = test_nn(model, X_test, y_test, avg=False)
-      for a in approx:
-          if a == None: break
-          else: all_approx.append(a)
-      for a in actual:
-          if a == None: break
-          else: all_actual.append(a)
-      for l in losses:
-          if l == None: break
-          else: all_losses.append(l)
+      all_approx.extend(approx)
+      all_actual.extend(actual)
+      all_losses.extend(losses)
     n+=1
     progress_bar.value = n
 
+  if scramble_trait and importance:
+    return importance_summary(np.concatenate(draws), labels, confidence)
+
   if (scramble_trait or remove_trait):
     # average by trait
     for key in trait_loss:
@@ -234,9 +235,133 @@ def cross_validation(X, y, batch_size, n_iterations, scramble_trait=False, remov
     return trait_loss     
   
   else: # return calculated values
-     return all_approx, all_actual, all_losses
+     return np.array(all_approx), np.array(all_actual), np.array(all_losses)
+
+def report_stop(model, n, label=None):
+  '''
+  prints the epoch that training stopped at, for models trained with early stopping (see train_nn)
+  '''
+  if getattr(model, 'early_stopping', False):
+    print(f'{label + " " if label else ""}iteration {n} stopped after {model.stop_epoch} epochs, best epoch: {model.best_epoch}')
+  return
+
+def subject_index(time_points):
+  '''
+  gets the subject of every row, where each subject's rows are consecutive and start at a time point of 0
+
+    param time_points: time point of every row, in order, numpy array
+    return: subject of every row, numbered from 0, numpy array
+  '''
+
+  starts = (np.asarray(time_points) == 0)
+
+  # rows before the first time point of 0 are given to the first subject
+  return np.maximum(np.cumsum(starts) - 1, 0)
+
+def ablation_variants(columns):
+  '''
+  lists the traits removed for each model trained by cross_validation with remove_trait, or scrambled with scramble_trait,
+  first each trait alone, then each trait along with time point, with both strain columns removed together
+
+    param columns: all input columns, list
+    return: the label of each variant, e.g. 'Strain_no_time', and the columns it removes, list of tuples
+  '''
+
+  variants = []
+  for status in ['with_time', 'no_time']:
+    for column in columns:
+      # if time is removed, and time is slated to be removed, skip this variant
+      if (status == 'no_time') and (column == 'time_point_in_study_weeks'): continue
+      # check the strain, we want to remove both at once
+      if 'C57BL6J or Sv129Ev' in column:
+        continue
+      elif 'CD1 or C57BL6J' in column:
+        removed, name = [column, 'C57BL6J or Sv129Ev'], 'Strain'
+      else:
+        removed, name = [column], column
+      if status == 'no_time': removed = removed + ['time_point_in_study_weeks']
+      variants.append((f'{name}_{status}', removed))
+
+  return variants
+
+def scramble_losses(model, X_test, y_test, n_repeats=1, rng=None):
+  '''
+  gets the loss of every sample with each of the ablation_variants traits replaced by standard normal noise,
+  all of the variants (repeats x variants x samples x inputs) are stacked and evaluated in a single forward pass
+
+    param model: trained neural network, pytorch object
+    param X_test: input values, df
+    param y_test: expected output values, df
+    param n_repeats: number of noise draws per variant, int
+    param rng: random generator the noise is drawn from, or a seed for one, if None a new unseeded one, np.random.Generator or int
+
+    return: the label of each variant, list, the losses (repeats x variants x samples), and the unscrambled losses, numpy arrays
+  '''
+  import torch
+
+  variants = ablation_variants(X_test.columns)
+  labels = [label for label, _ in variants]
+  scrambled = np.array([X_test.columns.isin(removed) for _, removed in variants]) # variants x inputs
+
+  # stack the noise and the test data by the scrambled traits
+  values = X_test.values.astype('float32')
+  noise = np.random.default_rng(rng).standard_normal(size=(n_repeats, len(variants)) + values.shape, dtype='float32')
+  stacked = np.where(scrambled[None, :, None, :], noise, values)
+
+  model.eval()
+  with torch.no_grad():
+    outputs = model(torch.from_numpy(np.concatenate([values, stacked.reshape(-1, values.shape[1])]))).numpy().ravel()
+  errors = np.abs(outputs - np.tile(np.asarray(y_test, dtype='float32'), 1 + n_repeats*len(variants))).astype('float64')
+
+  baseline = errors[:len(values)]
+  losses = errors[len(values):].reshape(n_repeats, len(variants), len(values))
+
+  return labels, losses, baseline
+
+def scramble_importance(model, X_test, y_test, n_repeats=10, confidence=0.95, rng=None):
+  '''
+  gets the importance of each trait as the increase in loss when it is scrambled, see scramble_losses
 
-def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_every=50):
+    param model: trained neural network, pytorch object
+    param X_test: input values, df
+    param y_test: expected output values, df
+    param n_repeats: number of noise draws per trait, int
+    param confidence: confidence level of the intervals, float
+    param rng: random generator the noise is drawn from, or a seed for one, np.random.Generator or int
+
+    return: importance by trait, see importance_summary, df
+  '''
+
+  labels, losses, baseline = scramble_losses(model, X_test, y_test, n_repeats=n_repeats, rng=rng)
+
+  return importance_summary(losses.mean(axis=2) - baseline.mean(), labels, confidence)
+
+def importance_summary(draws, labels, confidence=0.95):
+  '''
+  summarizes the increase in loss by trait over repeated draws (noise draws and/or cross validation iterations)
+
+    param draws: increase in the mean loss, draws x traits, numpy array
+    param labels: trait labels, list
+    param confidence: confidence level of the intervals, float
+
+    return: mean importance, its standard deviation over draws, t-distribution confidence interval of the mean 
+      (nan with a single draw) and the number of draws by trait, sorted by importance, df
+  '''
+  from scipy import stats
+
+  n_draws = draws.shape[0]
+  mean = draws.mean(axis=0)
+  std = draws.std(axis=0, ddof=1) if n_draws > 1 else np.full(len(labels), np.nan)
+  half_width = stats.t.ppf((1 + confidence)/2, n_draws - 1)*std/np.sqrt(n_draws) if n_draws > 1 else np.nan
+
+  summary = pd.DataFrame({'importance': mean, 'std': std, 'ci_low': mean - half_width, 'ci_high': mean + half_width, 'n_draws': n_draws}, 
+                         index=labels)
+
+  return summary.sort_values(by='importance', ascending=False)
+
+def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_every=50, fast=False, shuffle=False, seed=808,
+             patience=None, max_epochs=None, min_delta=0., smoothing=0.9, X_val=None, y_val=None, lr_decay=None, lr_patience=5,
+             max_restarts=10, max_loss=75.):
   '''
   trains neural network model
 
@@ -246,13 +371,38 @@ def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_e
     param bar: whether to display and update the progress bar with each iteration
     param print_epochs: whether to print the number of epochs
     param print_every: how often to print the loss by number of epochs, if 0 doesn't print
-
-    return: most optimal neural network model identified throughout training, pytorch object
+    param fast: whether to slice the batches directly from the tensors rather than through a DataLoader, 
+      and to snapshot the best weights rather than copying the whole model, gives the same losses, bool
+    param shuffle: with fast, whether to shuffle the rows each epoch, bool
+    param seed: random seed set before training, int
+    param patience: if set, stop once the monitored loss hasn't improved by min_delta for this many epochs, int
+      the monitored loss is the validation loss if X_val/y_val are given, otherwise the smoothed mean training loss of each epoch,
+      and the best model is chosen by it rather than by the loss of the last batch
+    param max_epochs: maximum number of epochs, if None the number of batches as before, int
+    param min_delta: minimum decrease in the monitored loss that counts as an improvement, float
+    param smoothing: weight of the previous epochs in the smoothed training loss, float
+    param X_val: validation set input, df
+    param y_val: validation set output, df
+    param lr_decay: if set, multiply the learning rate by this factor after lr_patience epochs without improvement, float
+    param lr_patience: number of epochs without improvement before decaying the learning rate, int
+    param max_restarts: certain sets of initialized weights don't train well, so training restarts from new weights 
+      when the monitored loss never gets below max_loss, at most this many times, after which the last model is returned 
+      with a warning, int
+    param max_loss: the monitored loss a model has to get below to count as trained, float
+
+    return: most optimal neural network model identified throughout training, pytorch object,
+      with the number of epochs run, the epoch of the best model and whether patience was set as its 
+      stop_epoch, best_epoch and early_stopping attributes
   
   '''
+  import torch
+  import torch.nn as nn
+  from torch.utils.data import DataLoader, TensorDataset
+  from ipywidgets import IntProgress
+  from IPython.display import display
 
   # set random seed
-  set_seed(808) # arbitrary
+  set_seed(seed)
 
   n_inputs = X_train.shape[1]
 
@@ -265,21 +415,32 @@ def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_e
   # determine the number of epochs from batch size and number of observations
   epochs = X_train.shape[0]//batch_size
   if X_train.shape[0]%batch_size > 0: epochs+=1
+  if max_epochs is not None: epochs = max_epochs
   if print_epochs: print(f'\nNumber of epochs: {epochs}\n')
 
+  if X_val is not None:
+    X_val = torch.tensor(X_val.values, dtype=torch.float32)
+    y_val = torch.tensor(np.asarray(y_val), dtype=torch.float32).view(-1, 1)
+  monitor = (patience is not None) or (lr_decay is not None)
+
   criterion = nn.L1Loss()
   dataset = TensorDataset(X_train, y_train)
   dataloader = DataLoader(dataset, batch_size=batch_size)
+  n_rows = X_train.shape[0]
     
-  while True: # certain sets of initialized weights don't train well, so when we encounter these we restart training for the iteration
+  for attempt in range(max_restarts + 1): # certain sets of initialized weights don't train well, so when we encounter these we restart training for the iteration
 
-    model = Model(n_inputs)
+    model = model_class()(n_inputs)
     optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    if lr_decay is not None:
+      scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=lr_decay, patience=lr_patience, threshold=min_delta, threshold_mode='abs')
     model.train()
 
-    # set boundaries on training inefficiency
-    last_loss = 75
-    best_loss = last_loss
+    best_loss = float('inf')
+    best_state = None
+    best_epoch = None
+    smoothed_loss = None
+    wait = 0
 
     # display and update progress bar
     if bar:
@@ -287,7 +448,19 @@ def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_e
       display(progress_bar)
 
     for i in range(epochs):
-        for inputs, targets in dataloader:
+        if fast: # slice the batches from contiguous tensors, shuffling within the tensors if needed
+          if shuffle:
+            order = torch.randperm(n_rows)
+            X_epoch, y_epoch = X_train[order], y_train[order]
+          else:
+            X_epoch, y_epoch = X_train, y_train
+          batches = ((X_epoch[start:start+batch_size], y_epoch[start:start+batch_size]) for start in range(0, n_rows, batch_size))
+        else:
+          batches = dataloader
+
+        epoch_loss = 0
+        n_batches = 0
+        for inputs, targets in batches:
 
           outputs = model(inputs)
           loss = criterion(outputs, targets)
@@ -296,6 +469,23 @@ def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_e
           loss.backward()
           optimizer.step()
 
+          if monitor:
+            epoch_loss += loss.item()
+            n_batches += 1
+
+        # get the loss to monitor for convergence, otherwise the loss of the last batch
+        if X_val is not None:
+          model.eval()
+          with torch.no_grad():
+            score = criterion(model(X_val), y_val).item()
+          model.train()
+        elif monitor:
+          epoch_loss /= n_batches
+          smoothed_loss = epoch_loss if smoothed_loss is None else smoothing*smoothed_loss + (1 - smoothing)*epoch_loss
+          score = smoothed_loss
+        else:
+          score = loss.item()
+
         # print every x epochs
         if print_every == 0:
            pass
@@ -303,13 +493,214 @@ def train_nn(X_train, y_train, batch_size, bar=False, print_epochs=True, print_e
           print(f'Epoch: {i}, Loss: {loss}')
         
         # update best performing model
-        if loss < best_loss:
-           best_loss = loss
-           best_model = copy.deepcopy(model)
-
+        if score < best_loss - min_delta:
+           best_loss = score
+           best_epoch = i
+           wait = 0
+           if fast: best_state = {key: val.detach().clone() for key, val in model.state_dict().items()}
+           else: best_model = copy.deepcopy(model)
+        else:
+           wait += 1
+
+        if lr_decay is not None: scheduler.step(score)
         if bar: progress_bar.value = i+1
 
-    return best_model
+        # stop once converged
+        if (patience is not None) and (wait >= patience):
+          break
+
+    if (best_epoch is not None) and (best_loss < max_loss): # otherwise restart with new weights
+      break
+
+  else:
+    if best_epoch is None: # every loss was nan
+      raise RuntimeError(f'training gave no finite loss in {max_restarts + 1} attempts')
+    warnings.warn(f'the loss never got below max_loss={max_loss} in {max_restarts + 1} attempts, returning the last model (loss {best_loss:.4g})')
+
+  if fast:
+    best_model = copy.deepcopy(model) # copied once, then given the best weights
+    best_model.load_state_dict(best_state)
+
+  best_model.stop_epoch = i + 1
+  best_model.best_epoch = best_epoch
+  best_model.early_stopping = patience is not None
+  if print_epochs and (patience is not None): print(f'Stopped after {i + 1} epochs, best epoch: {best_epoch}')
+
+  return best_model
+
+def train_ensemble(X_trains, y_trains, batch_size, print_every=0, seed=808, max_restarts=10, max_loss=75.):
+  '''
+  trains independent models together as one batched ensemble, e.g. the folds or removed trait variants of cross_validation,
+  each model is trained as in train_nn, but their weights are stacked so that every step is one batched forward/backward pass
+  certain sets of initialized weights don't train well, so the models that never get below max_loss are trained again together,
+  from seed + 1, seed + 2, ..., so that the results are still reproducible
+
+    param X_trains: training set inputs, one per model, may differ in rows and columns, list of dfs
+    param y_trains: training set outputs, one per model, list of dfs
+    param batch_size: batch size for each model, int
+    param print_every: how often to print the mean loss across models by number of epochs, if 0 doesn't print
+    param seed: random seed set before initializing each model, so that it starts from the same weights as in train_nn,
+      if None the weights are drawn from the current random state, int
+    param max_restarts: the most times models are trained again, int
+    param max_loss: the loss a model has to get below to count as trained, float
+
+    return: most optimal model identified for each training set, list of pytorch objects
+  '''
+
+  models = [None]*len(X_trains)
+  pending = list(range(len(X_trains)))
+  for attempt in range(max_restarts + 1):
+    fitted, best_loss = fit_ensemble([X_trains[k] for k in pending], [y_trains[k] for k in pending], batch_size, print_every, 
+                                     seed=None if seed is None else seed + attempt)
+    for k, model in zip(pending, fitted): models[k] = model
+
+    pending = [k for k, loss in zip(pending, best_loss.tolist()) if not loss < max_loss]
+    if not pending:
+      return models
+
+  raise RuntimeError(f'models {pending} did not get below a loss of {max_loss} in {max_restarts + 1} attempts')
+
+def fit_ensemble(X_trains, y_trains, batch_size, print_every=0, seed=808):
+  '''
+  trains the models of train_ensemble once, as one batched ensemble
+
+  models with fewer rows are masked out once they run out of batches and epochs, 
+  and models with fewer inputs are zero padded, which leaves their extra weights at 0
+
+    param X_trains: training set inputs, one per model, may differ in rows and columns, list of dfs
+    param y_trains: training set outputs, one per model, list of dfs
+    param batch_size: batch size for each model, int
+    param print_every: how often to print the mean loss across models by number of epochs, if 0 doesn't print
+    param seed: random seed set before initializing each model, if None the weights are drawn from the current random state, int
+
+    return: most optimal model identified for each training set, list of pytorch objects, and the loss of each, tensor
+  '''
+  import torch
+
+  n_models = len(X_trains)
+  n_inputs = [X_train.shape[1] for X_train in X_trains]
+  n_rows = torch.tensor([X_train.shape[0] for X_train in X_trains])
+  n_batches = (n_rows + batch_size - 1)//batch_size # also the number of epochs, as in train_nn
+
+  # zero pad the data into (models, rows, inputs) tensors
+  X = torch.zeros(n_models, int(n_rows.max()), max(n_inputs))
+  y = torch.zeros(n_models, int(n_rows.max()), 1)
+  for k in range(n_models):
+    X[k, :n_rows[k], :n_inputs[k]] = torch.tensor(X_trains[k].values, dtype=torch.float32)
+    y[k, :n_rows[k], 0] = torch.tensor(np.asarray(y_trains[k]), dtype=torch.float32)
+  valid = torch.arange(X.shape[1]) < n_rows[:, None]
+
+  # initialize each model as in train_nn, then stack the weights
+  models = []
+  for k in range(n_models):
+    if seed is not None: set_seed(seed)
+    models.append(model_class()(n_inputs[k]))
+  names = list(models[0].state_dict())
+  params = []
+  for name in names:
+    if name == 'fc1.weight': # pad the inputs
+      weight = torch.zeros(n_models, models[0].fc1.out_features, max(n_inputs))
+      for k, model in enumerate(models): weight[k, :, :n_inputs[k]] = model.fc1.weight.detach()
+      params.append(weight.requires_grad_())
+    else:
+      params.append(torch.stack([model.state_dict()[name] for model in models]).requires_grad_())
+  W1, b1, W2, b2, W3, b3 = params
+
+  # adam, as in torch.optim.Adam(lr=0.001), but only stepping the models with a batch
+  lr, beta1, beta2, eps = 0.001, 0.9, 0.999, 1e-8
+  exp_avg = [torch.zeros_like(param) for param in params]
+  exp_avg_sq = [torch.zeros_like(param) for param in params]
+  steps = torch.zeros(n_models)
+
+  last_loss = torch.full((n_models,), float('inf'))
+  best_loss = last_loss.clone()
+  best_params = [param.detach().clone() for param in params]
+
+  for i in range(int(n_batches.max())):
+    for j in range(int(n_batches.max())):
+      active = (i < n_batches) & (j < n_batches)
+      rows = slice(j*batch_size, (j+1)*batch_size)
+      mask = valid[:, rows] & active[:, None]
+
+      outputs = torch.relu(torch.baddbmm(b1.unsqueeze(1), X[:, rows], W1.transpose(1, 2)))
+      outputs = torch.relu(torch.baddbmm(b2.unsqueeze(1), outputs, W2.transpose(1, 2)))
+      outputs = torch.baddbmm(b3.unsqueeze(1), outputs, W3.transpose(1, 2))
+
+      # l1 loss of each model's batch, the models are independent so the summed loss gives each its own gradient
+      errors = (outputs - y[:, rows]).abs().squeeze(-1)*mask
+      losses = errors.sum(1)/mask.sum(1).clamp(min=1)
+
+      for param in params: param.grad = None
+      losses.sum().backward()
+
+      with torch.no_grad():
+        steps += active
+        bias1 = 1 - beta1**steps.clamp(min=1)
+        bias2 = 1 - beta2**steps.clamp(min=1)
+        for param, avg, avg_sq in zip(params, exp_avg, exp_avg_sq):
+          shape = (-1,) + (1,)*(param.dim() - 1)
+          step = active.view(shape)
+          avg.copy_(torch.where(step, avg.lerp(param.grad, 1 - beta1), avg))
+          avg_sq.copy_(torch.where(step, avg_sq*beta2 + (1 - beta2)*param.grad**2, avg_sq))
+          denom = avg_sq.sqrt()/bias2.sqrt().view(shape) + eps
+          param -= torch.where(step, (lr/bias1).view(shape)*avg/denom, 0.)
+        last_loss = torch.where(active, losses.detach(), last_loss)
+
+    # update best performing models, from the loss of their last batch
+    better = (i < n_batches) & (last_loss < best_loss)
+    best_loss = torch.where(better, last_loss, best_loss)
+    for best, param in zip(best_params, params):
+      best.copy_(torch.where(better.view((-1,) + (1,)*(param.dim() - 1)), param.detach(), best))
+
+    # print every x epochs
+    if print_every == 0:
+       pass
+    elif (i % print_every) == 0:
+      print(f'Epoch: {i}, Mean loss: {last_loss.mean()}')
+
+  # unstack the best weights into separate models
+  for k, model in enumerate(models):
+    state = {name: best[k] for name, best in zip(names, best_params)}
+    state['fc1.weight'] = state['fc1.weight'][:, :n_inputs[k]]
+    model.load_state_dict(state)
+
+  return models, best_loss
+
+def train_pool(X_trains, y_trains, batch_size, n_jobs=2, torch_threads=1, seed=808, train_options=None):
+  '''
+  trains independent models with train_nn in a pool of worker processes, e.g. the folds or removed trait variants of cross_validation,
+  each model sets the same seed before training, so its weights don't depend on which worker trains it or when
+  the pool is spawned on every call, and each worker imports torch, which takes seconds, so this is slower than training 
+  in serial when the models train quickly, e.g. on small data
+
+    param X_trains: training set inputs, one per model, list of dfs
+    param y_trains: training set outputs, one per model, list of dfs
+    param batch_size: batch size for each model, int
+    param n_jobs: number of worker processes, int
+    param torch_threads: number of torch threads per worker, so that the workers don't oversubscribe the cores, int
+    param seed: random seed set before training each model, int
+    param train_options: further arguments of train_nn, e.g. {'patience': 10}, dict
+
+    return: most optimal model identified for each training set, in order, list of pytorch objects
+  '''
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+
+  # spawned rather than forked, since forking after torch has started its thread pool can hang the workers
+  with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                           initializer=init_train_worker, initargs=(torch_threads,)) as executor:
+    futures = [executor.submit(train_nn, X_train, y_train, batch_size, bar=False, print_epochs=False, print_every=0, seed=seed, **(train_options or {}))
+               for X_train, y_train in zip(X_trains, y_trains)]
+    return [future.result() for future in futures]
+
+def init_train_worker(torch_threads):
+  '''
+  limits the number of torch threads of a train_pool worker process
+  '''
+  import torch
+
+  torch.set_num_threads(torch_threads)
+  return
 
 def test_nn(model, X_val, y_val, avg=True):
   '''
@@ -318,8 +709,10 @@ def test_nn(model, X_val, y_val, avg=True):
   param X_val: input values, DataFrame
   param y_val: expected output values, DataFrame
   param avg: whether to return averaged loss (True) or individual losses (False) and approx/actual, boolean
-  return: 3 lists containing the model's predictions, the actual values, and the loss values, or just the loss
+  return: 3 arrays containing the loss values, the model's predictions, and the actual values, or just the loss
   '''
+  import torch
+  import torch.nn as nn
 
   model.eval()
 
@@ -338,26 +731,140 @@ def test_nn(model, X_val, y_val, avg=True):
       loss = criterion(outputs, y_val)
       return loss.item()
     
-    else: # get the loss for every prediction
+    else: # get the loss for every prediction, from the same forward pass
 
-      dataset = TensorDataset(X_val, y_val)
-      dataloader = DataLoader(dataset)
+      losses = (outputs - y_val).abs()
 
-      approx = []
-      actual = []
-      losses = []
+      # as float64, like the floats of the per-sample losses
+      return losses.numpy().ravel().astype('float64'), outputs.numpy().ravel().astype('float64'), y_val.numpy().ravel().astype('float64')
+       
+def elastic_net_cv(X, y, l1_ratios=[.1, .5, .7, .9, .95, .99, 1], n_alphas=100, alphas=None, eps=1e-3, cv=6, random_state=808, 
+                   n_jobs=1, tol=1e-4, max_iter=1000):
+  '''
+  tunes an ElasticNet (as sklearn's, i.e. unstandardized, with an intercept) over its whole regularization path,
+  rather than GridSearchCV fitting every grid point from scratch
+
+  every fold computes the path of each l1 ratio with elastic_net_path, warm started and screened, 
+  the folds are shared by all grid points and run in parallel, then the best grid point is refit on all of the data
+
+    param X: input values, m = animals, n = probes, df
+    param y: expected output values, df
+    param l1_ratios: l1 ratios to search, greater than 0, list
+    param n_alphas: number of alphas per l1 ratio, from the smallest alpha that sets every coefficient to 0 down to eps times it, int
+    param alphas: alphas to search for every l1 ratio, replaces n_alphas and eps, list
+    param eps: ratio of the smallest to the largest alpha, float
+    param cv: number of folds, int
+    param random_state: random state of the shuffled folds, int
+    param n_jobs: number of folds run at once, in threads, int
+    param tol: tolerance of each coordinate descent fit, as in sklearn, float
+    param max_iter: maximum number of iterations of each coordinate descent fit, int
+
+    return: the best alpha and l1_ratio, the coefficients (series, by probe) and intercept fit on all data, 
+      and the mean and std of the held out mean squared error of every grid point (df), dict
+  '''
+  from sklearn.model_selection import KFold
+  from concurrent.futures import ThreadPoolExecutor
 
-      for inputs, targets in dataloader:
+  columns = X.columns if isinstance(X, pd.DataFrame) else None
+  X = np.asarray(X, dtype='float64')
+  y = np.asarray(y, dtype='float64').ravel()
 
-        outputs = model(inputs)
-        loss = criterion(outputs, targets)
+  # alphas by l1 ratio, largest first
+  if alphas is None:
+    alpha_max = np.abs((X - X.mean(axis=0)).T @ (y - y.mean())).max()/X.shape[0]
+    alpha_grid = {l1_ratio: np.geomspace(alpha_max/l1_ratio, eps*alpha_max/l1_ratio, n_alphas) for l1_ratio in l1_ratios}
+  else:
+    alpha_grid = {l1_ratio: np.sort(alphas)[::-1] for l1_ratio in l1_ratios}
+
+  # the same folds for every grid point
+  folds = list(KFold(n_splits=cv, shuffle=True, random_state=random_state).split(X))
+
+  def fold_errors(fold):
+    train, test = fold
+    errors = {}
+    for l1_ratio in l1_ratios:
+      path = elastic_net_path(X[train], y[train], alpha_grid[l1_ratio], l1_ratio=l1_ratio, tol=tol, max_iter=max_iter)
+      errors[l1_ratio] = [np.mean((y[test] - X[test][:, active] @ coef - intercept)**2) for active, coef, intercept in path]
+    return errors
+
+  # the coordinate descent releases the GIL, so the folds run in threads
+  with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+    fold_results = list(executor.map(fold_errors, folds))
+
+  rows = []
+  for l1_ratio in l1_ratios:
+    errors = np.array([result[l1_ratio] for result in fold_results]) # folds x alphas
+    for alpha, fold_error in zip(alpha_grid[l1_ratio], errors.T):
+      rows.append({'l1_ratio': l1_ratio, 'alpha': alpha, 'mse_mean': fold_error.mean(), 'mse_std': fold_error.std()})
+  cv_results = pd.DataFrame(rows)
+
+  # refit the best grid point on all of the data, warm started along its path
+  best = cv_results.loc[cv_results['mse_mean'].idxmin()]
+  alpha_path = alpha_grid[best['l1_ratio']]
+  alpha_path = alpha_path[:np.flatnonzero(alpha_path == best['alpha'])[0] + 1]
+  active, values, intercept = elastic_net_path(X, y, alpha_path, l1_ratio=best['l1_ratio'], tol=tol, max_iter=max_iter)[-1]
+
+  coef = np.zeros(X.shape[1])
+  coef[active] = values
+
+  return {'alpha': best['alpha'], 'l1_ratio': best['l1_ratio'], 'coef': pd.Series(coef, index=columns), 
+          'intercept': intercept, 'cv_results': cv_results}
+
+def elastic_net_path(X, y, alphas, l1_ratio=0.5, tol=1e-4, max_iter=1000):
+  '''
+  fits an ElasticNet at each alpha, from largest to smallest, each fit warm started from the last
 
-        losses.append(loss.item()) 
-        approx.append(outputs)
-        actual.append(targets)
+  coefficients discarded by the sequential strong rule are left out of each fit, 
+  and only added back if they violate its optimality (KKT) conditions, so each fit only sees the few probes that can be nonzero
+
+    param X: input values, m = samples, n = features, numpy array
+    param y: expected output values, numpy array
+    param alphas: regularization strengths, largest first, list
+    param l1_ratio: the ElasticNet l1 ratio, greater than 0, float
+    param tol: tolerance of each coordinate descent fit, as in sklearn, float
+    param max_iter: maximum number of iterations of each coordinate descent fit, int
+
+    return: for each alpha, the indices of the nonzero coefficients, their values and the intercept, list of tuples
+  '''
+  from sklearn.linear_model import enet_path
+
+  # centered, so the intercept is fit implicitly
+  n_samples = X.shape[0]
+  X_mean = X.mean(axis=0)
+  y_mean = y.mean()
+  X = X - X_mean
+  y = y - y_mean
+
+  coef = np.zeros(X.shape[1])
+  residual = y.copy()
+  active = np.zeros(X.shape[1], dtype=bool)
+  last_alpha = np.abs(X.T @ y).max()/(n_samples*l1_ratio) # the smallest alpha that sets every coefficient to 0
+
+  path = []
+  for alpha in alphas:
+    # strong rule, keeping the nonzero coefficients of the last fit
+    keep = active | (np.abs(X.T @ residual)/n_samples >= l1_ratio*(2*alpha - last_alpha))
+
+    while True:
+      kept = np.flatnonzero(keep)
+      if len(kept) > 0: # warm started from the last fit, the coefficients that weren't kept are all 0
+        _, kept_coef, _ = enet_path(np.asfortranarray(X[:, kept]), y, l1_ratio=l1_ratio, alphas=[alpha], coef_init=coef[kept], 
+                                    tol=tol, max_iter=max_iter, precompute=False)
+        coef[kept] = kept_coef[:, 0]
+      residual = y - X[:, kept] @ coef[kept]
+
+      # add back any discarded coefficients that should be nonzero
+      violated = ~keep & (np.abs(X.T @ residual)/n_samples > l1_ratio*alpha*(1 + 1e-6))
+      if not violated.any():
+        break
+      keep |= violated
+
+    active = coef != 0
+    last_alpha = alpha
+    path.append((np.flatnonzero(active), coef[active], y_mean - X_mean[active] @ coef[active]))
+
+  return path
 
-      return losses, approx, actual
-       
 def generate_nn_pred(model, X):
   '''
   gets predictions for input values using trained NN
@@ -367,6 +874,8 @@ def generate_nn_pred(model, X):
 
     returns: n predictions, numpy array
   '''
+  import torch
+
   model.eval()
 
   X = X.values
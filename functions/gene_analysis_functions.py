@@ -1,34 +1,36 @@
 '''
 functions that manipulate the web browser for the purposes of data analysis
-'''
-from selenium import webdriver
-
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait, Select
-
-from selenium.webdriver.common.by import By
-
-from bs4 import BeautifulSoup
 
+the browser stack (selenium, webdriver_manager, bs4, requests), liftover and matplotlib are imported 
+by the functions that use them, so that the rest of the module can be used without them installed
+'''
 import os
-import requests
+import io
+import json
+import hashlib
+import gzip
+import shutil
+import tempfile
 
-import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 
 import string
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from liftover import get_lifter
+from data_loading_functions import file_hash, evict_lru
 
 
+CISTROME_URL = 'http://dbtoolkit.cistrome.org'
+CISTROME_ASSEMBLY = 'Mouse mm10'
+RESULT_ROW = 'table.table.table-bordered.table-hover tbody tr' # rows of the main results table
 
 def get_cistrome(probe_data, fig_w=2800, fig_h=3000, 
-                 check_coef=True, top_10k=False):
+                 check_coef=True, top_10k=False, n_drivers=1, base_url=CISTROME_URL, driver_factory=None,
+                 cache_dir=None, cache_max_mb=500, all_rows=False, timeout=60, report_timing=False, screenshot_dir=None):
 
     '''
     generates cistrome plots using the inputted data
@@ -39,35 +41,27 @@ def get_cistrome(probe_data, fig_w=2800, fig_h=3000,
         check_coef: if the code should check for columns with '_coef' to determine how to rank probes,
             ranking with the highest absolute coef being moved to the top, etc., bool.
         top_10k: if the code should utilize the top 10k probes from the dataset, or use the default 1k, bool
-
-        return: none
+        n_drivers: number of browser sessions, traits are submitted concurrently across them, int
+        base_url: address of the Cistrome DB toolkit, or of a local stand-in mimicking its pages, str
+        driver_factory: function returning a new webdriver, if None a headless Chrome is used
+        cache_dir: directory to cache results in, keyed by the BED content, assembly, top 1k/10k mode, base_url and all_rows, 
+            so unchanged traits aren't resubmitted; if None nothing is cached, str
+        cache_max_mb: size of the cache, the least recently used results are removed beyond it, float
+        all_rows: if the results table offers it, show all rows on one page rather than clicking through pages, bool
+        timeout: the longest to wait for any one page change, in seconds, float
+        report_timing: if True, also returns the time each trait took to submit, wait, scrape and download, bool
+        screenshot_dir: for debugging, a directory to save a screenshot of each trait's results page to, 
+            as trait_<n>.png in trait order, if None no screenshots are taken, str
+
+        return: biosample associated factors by trait, dict
+                if report_timing = True, also the timing breakdown by trait, dict
     '''
 
-    # establish settings
-    options = Options()
+    import matplotlib.pyplot as plt
 
-    # chrome options
-    options = Options()
-    options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-    options.add_argument("--headless")  
-    options.add_argument("--incognito")
-    options.add_experimental_option("excludeSwitches", ["enable-automation"])
-    options.add_experimental_option('useAutomationExtension', False)
-
-    # establish webdriver
-    #driver = webdriver.Chrome(service=Service(), options=options)
-
-    # avoid detection by web security
-    #driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-
-    ############
-
-    # iterate through data and produce graphs
-    images = []
-    labels = []
-    trait_factors = {}
-    
-    n_traits = 0
+    # prep the probes of each trait, writing them to their own BED file
+    bed_dir = tempfile.mkdtemp(prefix='cistrome_')
+    submissions = []
     for column in probe_data.columns:
         if (('_coef' in str(column)) or (not check_coef)):
 
@@ -92,130 +86,48 @@ def get_cistrome(probe_data, fig_w=2800, fig_h=3000,
                 continue
 
             # create target file
-            bed_data.to_csv('temp.txt', sep='\t', index=False, header=False)
-
-            # re-establish driver
-            driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()),
-                            options=options)
+            bed_path = os.path.join(bed_dir, f'trait_{len(submissions)}.bed')
+            bed_data.to_csv(bed_path, sep='\t', index=False, header=False)
 
-            # direct driver to Cistrome
-            driver.get('http://dbtoolkit.cistrome.org')
-
-            # change assembly to mm10
-            select = Select(driver.find_element(By.XPATH, '/html/body/div[4]/div/div/div/div[2]/div/form/div[1]/div[2]/div[1]/div/select'))
-            select.select_by_visible_text('Mouse mm10')
-
-            # if you want the top 10k probes to be used, select the top 10k option
-            if top_10k:
-                select = Select(driver.find_element(By.XPATH, '/html/body/div[4]/div/div/div/div[2]/div/form/div[1]/div[4]/div[1]/div/select'))
-                select.select_by_visible_text('Top 10k peaks according to peak enrichment')
-            else:
-                pass
-
-            # select 'choose file' button
-            select_file = WebDriverWait(driver, 20).until(EC.element_to_be_clickable((By.ID, 'peak')))
-
-            # upload probe set
-            select_file.send_keys(str(os.getcwd()) + '/temp.txt')
-
-            # press submit button
-            submit_button = driver.find_element(By.XPATH, '/html/body/div[4]/div/div/div/div[2]/div/form/div[2]/div[2]/input')
-            submit_button.click()
-
-            # get the biosample associated factors
-            bio_factors = {}
-
-            try: soup = BeautifulSoup(driver.page_source, 'lxml')
-            except: soup = BeautifulSoup(driver.page_source, 'html.parser')
-
-            i = 1
-            while i < 10:
-                tables = soup.find_all('table', class_='table table-bordered table-hover') # main table
-                try:
-                    all_associations = tables[0].find_all('tr')[1:] # all associations on the first page, skipping the header
-                except IndexError:
-                    bio_factors['None'] = None
-                    break
-                for sample in all_associations: # for row in table
-                    info = sample.select('td')
-                    if info[5].get_text(strip=True) == 0: # if a GIGGLE score of 0
-                        break
-                    if info[3].get_text(strip=True) in bio_factors:
-                        bio_factors[info[3].get_text(strip=True)].append(info[4].get_text(strip=True)) # add factor to dictionary
-                    else:
-                        bio_factors[info[3].get_text(strip=True)] = [info[4].get_text(strip=True)]
-                
-                # go to the next page
-                i+=1
-                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);") # scroll to the bottom of the page
-                next_button = driver.find_element(By.LINK_TEXT, str(i))
-                next_button.click()
-
-            if check_coef:
-                trait_factors[column[:-5]] = bio_factors
-            else:
-                trait_factors[column] = bio_factors
-
-            driver.execute_script("window.scrollTo(0, 0);") # scroll to the top of the page
-
-            # select figures
-            screenshot(driver)
-            show_plot = driver.find_element(By.LINK_TEXT, 'Result in figure')
-            show_plot.click()
-
-            # select iframe
-            iframe = driver.find_element(By.XPATH, '/html/body/div[2]/div/div/div/div[2]/div[3]/div/div[2]/iframe')
-            driver.switch_to.frame(iframe)
-
-            # select static plot
-            static = driver.find_element(By.ID, 'staticli')
-            static.click()
-
-            # make plot larger
-            plot_full = driver.find_element(By.LINK_TEXT, 'Download')
-            plot_full.click()
-            driver.switch_to.window(driver.window_handles[1]) #focus driver on newly opened tab
-
-            # save plot
-            png_element = driver.find_element(By.TAG_NAME, 'img')
-            png_url = png_element.get_attribute('src')
-            response = requests.get(png_url)
-
-            # save image to working directory
-            question_mark = False
-            if check_coef:
-                file_name = f'{column[:-5]}_temp_img.png'
-            else:
-                file_name = f'{column}_temp_img.png'
-            if '?' in file_name:
-                file_name = file_name.replace('?', 'xYZabC')
-                question_mark = True
-            try:
-                with open(file_name, 'wb') as file:
-                    file.write(response.content)
-            except FileNotFoundError:
-                if '/' in file_name:
-                    file_name = file_name.replace('/', '_')
-                    with open(file_name, 'wb') as file:
-                        file.write(response.content)
-
-                else:
-                    print('Error: illegal character in trait name, modify exception accordingly')
-                    pass
-            path = os.path.join(os.getcwd(), file_name)
-        
-            images.append(path)
-
-            if question_mark: file_name = file_name.replace('xYZabC', '?') # if there is a question mark
-            labels.append(file_name[:-13])
-
-            n_traits+=1
+            label = column[:-5] if check_coef else column
+            submissions.append((label, bed_path))
 
             if check_coef == False:
                 break
         else:
             pass
 
+    # check the cache for unchanged probe sets
+    results = [None] * len(submissions)
+    if cache_dir is not None:
+        keys = [cistrome_cache_key(bed_path, top_10k, base_url, all_rows) for _, bed_path in submissions]
+        results = [cistrome_cache_get(cache_dir, key) for key in keys]
+        results = [result + ({'cached': True},) if result is not None else None for result in results]
+    to_submit = [i for i, result in enumerate(results) if result is None]
+
+    # submit the remaining traits across the browser sessions, keeping the results in trait order
+    try:
+        if to_submit:
+            with DriverPool(n_drivers, driver_factory) as pool, ThreadPoolExecutor(max_workers=n_drivers) as executor:
+                submitted = executor.map(lambda i: pool.run(cistrome_lookup, submissions[i][1], top_10k, base_url,
+                                                            all_rows, timeout, screenshot_dir), to_submit)
+                for i, result in zip(to_submit, submitted):
+                    results[i] = result
+                    if cache_dir is not None:
+                        cistrome_cache_put(cache_dir, keys[i], *result[:2], max_bytes=cache_max_mb * 2**20)
+    finally:
+        shutil.rmtree(bed_dir, ignore_errors=True) # remove the BED files
+
+    trait_factors = {}
+    trait_timing = {}
+    images = []
+    labels = []
+    for (label, _), (bio_factors, png, timing) in zip(submissions, results):
+        trait_factors[label] = bio_factors
+        trait_timing[label] = timing
+        images.append(png)
+        labels.append(label)
+    n_traits = len(images)
 
     # establish subplots 
     px = 1/plt.rcParams['figure.dpi']
@@ -227,7 +139,7 @@ def get_cistrome(probe_data, fig_w=2800, fig_h=3000,
     # display images on subplots
     for i, ax in enumerate(axs.flat):
         try:
-            plot = plt.imread(images[i])
+            plot = plt.imread(io.BytesIO(images[i]), format='png')
             ax.imshow(plot, extent=[0, 1, 0, 1], aspect='auto')
             ax.axis('off')
             if check_coef: ax.set_title(labels[i], size=20)
@@ -239,27 +151,458 @@ def get_cistrome(probe_data, fig_w=2800, fig_h=3000,
         ax.text(0.1, 1.1, string.ascii_uppercase[i], transform=ax.transAxes, 
             size=25, weight='bold')
 
-    # remove temp file
-    os.remove('temp.txt')
+    if report_timing:
+        return trait_factors, trait_timing
+    return trait_factors
 
-    # remove images
-    for image in images:
-        os.remove(image)
+def cistrome_lookup(driver, bed_path, top_10k=False, base_url=CISTROME_URL, all_rows=False, timeout=60, screenshot_dir=None):
+    '''
+    submits a BED file to Cistrome and scrapes the results, leaving the driver on a single tab for reuse
+    every step waits on the page content rather than a fixed time
+
+        param driver: the driver to use, selenium webdriver
+        param bed_path: path of the BED file to submit, str
+        param top_10k: if the top 10k peaks option should be selected, bool
+        param base_url: address of the Cistrome DB toolkit, str
+        param all_rows: if the table offers a page length option, show all rows on one page rather than clicking through, bool
+        param timeout: the longest to wait for any one step, in seconds, float
+        param screenshot_dir: for debugging, a directory to save a screenshot of the results page to, named after the BED file 
+            so that concurrent drivers don't overwrite each other's, if None no screenshot is taken, str
+
+        return: biosample associated factors, dict, the result plot, png bytes, 
+            and the time taken to submit, wait for results, scrape and download, in seconds, dict
+    '''
 
-    driver.quit()
-    return trait_factors
+    import requests
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait, Select
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import TimeoutException
+
+    timing = {}
+    start = time.perf_counter()
+    wait = WebDriverWait(driver, timeout)
+
+    # direct driver to Cistrome
+    driver.get(base_url)
+
+    # change assembly to mm10
+    select = Select(wait.until(EC.presence_of_element_located((By.XPATH, '/html/body/div[4]/div/div/div/div[2]/div/form/div[1]/div[2]/div[1]/div/select'))))
+    select.select_by_visible_text(CISTROME_ASSEMBLY)
+
+    # if you want the top 10k probes to be used, select the top 10k option
+    if top_10k:
+        select = Select(driver.find_element(By.XPATH, '/html/body/div[4]/div/div/div/div[2]/div/form/div[1]/div[4]/div[1]/div/select'))
+        select.select_by_visible_text('Top 10k peaks according to peak enrichment')
+    else:
+        pass
+
+    # select 'choose file' button
+    select_file = wait.until(EC.element_to_be_clickable((By.ID, 'peak')))
+
+    # upload probe set
+    select_file.send_keys(os.path.abspath(bed_path))
+
+    # press submit button
+    submit_button = driver.find_element(By.XPATH, '/html/body/div[4]/div/div/div/div[2]/div/form/div[2]/div[2]/input')
+    submit_button.click()
+    timing['submit'] = time.perf_counter() - start
+
+    # wait for the first row of the main table
+    start = time.perf_counter()
+    try:
+        first_row = wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, RESULT_ROW)))
+    except TimeoutException:
+        first_row = None
+    timing['wait'] = time.perf_counter() - start
+
+    # get the biosample associated factors
+    start = time.perf_counter()
+    bio_factors = {}
+    if first_row is None:
+        bio_factors['None'] = None
+
+    elif all_rows and show_all_rows(driver, first_row, timeout):
+        add_factors(bio_factors, driver.page_source)
+
+    else:
+        i = 1
+        while i < 10:
+            add_factors(bio_factors, driver.page_source)
+
+            # go to the next page, if there is one
+            i+=1
+            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);") # scroll to the bottom of the page
+            next_buttons = driver.find_elements(By.LINK_TEXT, str(i))
+            if not next_buttons:
+                break
+            next_buttons[0].click()
+
+            # wait for the table to show the new page, rather than parsing the old one
+            try:
+                wait.until(lambda d: table_changed(d, first_row))
+            except TimeoutException:
+                break
+            first_row = driver.find_element(By.CSS_SELECTOR, RESULT_ROW)
+    timing['scrape'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    driver.execute_script("window.scrollTo(0, 0);") # scroll to the top of the page
+
+    if screenshot_dir is not None:
+        os.makedirs(screenshot_dir, exist_ok=True)
+        screenshot(driver, timeout, os.path.join(screenshot_dir, os.path.splitext(os.path.basename(bed_path))[0] + '.png'))
+
+    # select figures
+    show_plot = wait.until(EC.element_to_be_clickable((By.LINK_TEXT, 'Result in figure')))
+    show_plot.click()
+
+    # select iframe
+    wait.until(EC.frame_to_be_available_and_switch_to_it((By.XPATH, '/html/body/div[2]/div/div/div/div[2]/div[3]/div/div[2]/iframe')))
+
+    # select static plot
+    static = wait.until(EC.element_to_be_clickable((By.ID, 'staticli')))
+    static.click()
+
+    # make plot larger
+    main_window = driver.window_handles[0]
+    plot_full = wait.until(EC.element_to_be_clickable((By.LINK_TEXT, 'Download')))
+    plot_full.click()
+    wait.until(EC.number_of_windows_to_be(2))
+    driver.switch_to.window(driver.window_handles[1]) #focus driver on newly opened tab
+
+    # save plot
+    png_element = wait.until(EC.presence_of_element_located((By.TAG_NAME, 'img')))
+    png_url = png_element.get_attribute('src')
+    response = requests.get(png_url)
+
+    # close the plot tab so the driver can be reused
+    for handle in driver.window_handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(main_window)
+    timing['download'] = time.perf_counter() - start
+
+    return bio_factors, response.content, timing
+
+def add_factors(bio_factors, page_source):
+    '''
+    adds the biosample associated factors shown in the main results table to bio_factors
+
+        param bio_factors: factors by biosample, modified in place, dict
+        param page_source: html of the results page, str
+
+        return: none
+    '''
+
+    from bs4 import BeautifulSoup
+
+    try: soup = BeautifulSoup(page_source, 'lxml')
+    except: soup = BeautifulSoup(page_source, 'html.parser')
+
+    tables = soup.find_all('table', class_='table table-bordered table-hover') # main table
+    if not tables:
+        return
+    all_associations = tables[0].find_all('tr')[1:] # all associations on the page, skipping the header
+    for sample in all_associations: # for row in table
+        info = sample.select('td')
+        if info[5].get_text(strip=True) == 0: # if a GIGGLE score of 0
+            break
+        if info[3].get_text(strip=True) in bio_factors:
+            bio_factors[info[3].get_text(strip=True)].append(info[4].get_text(strip=True)) # add factor to dictionary
+        else:
+            bio_factors[info[3].get_text(strip=True)] = [info[4].get_text(strip=True)]
+
+    return
+
+def table_changed(driver, previous):
+    '''
+    checks whether the main results table shows a new page, for use with WebDriverWait
+    the rows of the previous page are removed from the page when it changes, even if the new rows have the same text
+
+        param driver: the driver to assess
+        param previous: first row of the table before it was changed, selenium element
+
+        return: bool
+    '''
+
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import StaleElementReferenceException
+
+    try:
+        previous.is_enabled()
+        return False # still shown
+    except StaleElementReferenceException:
+        pass
+
+    try:
+        return bool(driver.find_elements(By.CSS_SELECTOR, RESULT_ROW))
+    except StaleElementReferenceException: # the table is being redrawn
+        return False
+
+def show_all_rows(driver, first_row, timeout=60):
+    '''
+    selects the largest page length of the results table, if it offers one, and waits for it to be redrawn
+
+        param driver: the driver to use
+        param first_row: first row of the table before the change, selenium element
+        param timeout: the longest to wait for the redraw, in seconds, float
+
+        return: whether all rows are now shown on one page, bool
+    '''
+
+    from selenium.webdriver.support.ui import WebDriverWait, Select
+    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import TimeoutException
+
+    length_selects = driver.find_elements(By.CSS_SELECTOR, "select[name$='_length']")
+    if not length_selects:
+        return False
+
+    select = Select(length_selects[0])
+    values = [option.get_attribute('value') for option in select.options]
+    numeric = [int(value) for value in values if value.lstrip('-').isdigit()]
+    if not numeric:
+        return False
+    largest = -1 if -1 in numeric else max(numeric) # -1 is 'All'
+    current = select.first_selected_option.get_attribute('value')
+
+    # without a page 2 all rows already fit, and selecting the current length doesn't redraw, so neither would change the rows
+    if not driver.find_elements(By.LINK_TEXT, '2'):
+        return True
+    if current == str(largest):
+        return False
+
+    # some rows are on later pages, so the number of rows has to grow, the first row is kept so wait on the number instead
+    n_rows = len(driver.find_elements(By.CSS_SELECTOR, RESULT_ROW))
+    select.select_by_value(str(largest))
+    try:
+        WebDriverWait(driver, timeout).until(lambda d: len(d.find_elements(By.CSS_SELECTOR, RESULT_ROW)) != n_rows)
+    except TimeoutException:
+        return False
+
+    # only a single page if there is no page 2 to go to
+    return largest == -1 or not driver.find_elements(By.LINK_TEXT, '2')
+
+def cistrome_cache_key(bed_path, top_10k=False, base_url=CISTROME_URL, all_rows=False):
+    '''
+    gets the cache key of a Cistrome submission, from the BED content, assembly, top 1k/10k mode, 
+    the address it was submitted to and how the results table was read, 
+    so that results from a stand-in or read differently aren't served for other lookups
+
+        param bed_path: path of the BED file, str
+        param top_10k: if the top 10k peaks option is used, bool
+        param base_url: address of the Cistrome DB toolkit, str
+        param all_rows: if all rows were shown on one page, bool
+
+        return: sha256 hex digest, str
+    '''
+
+    sha = hashlib.sha256()
+    sha.update(file_hash(bed_path).encode())
+    sha.update(f'|{CISTROME_ASSEMBLY}|top_10k={top_10k}|{base_url}|all_rows={all_rows}'.encode())
+
+    return sha.hexdigest()
 
-def get_pos(probe_data, ref_data, drop_undef=True):
+def cistrome_cache_get(cache_dir, key):
+    '''
+    loads a cached Cistrome result, marking it as recently used
+
+        param cache_dir: cache directory, str
+        param key: output of cistrome_cache_key, str
+
+        return: biosample associated factors, dict, and the result plot, png bytes, or None if not cached
+    '''
+
+    json_path = os.path.join(cache_dir, f'{key}.json')
+    png_path = os.path.join(cache_dir, f'{key}.png')
+    if not (os.path.exists(json_path) and os.path.exists(png_path)):
+        return None
+
+    with open(json_path) as file:
+        bio_factors = json.load(file)
+    with open(png_path, 'rb') as file:
+        png = file.read()
+
+    for path in (json_path, png_path):
+        os.utime(path) # recently used, so evicted last
+
+    return bio_factors, png
+
+def cistrome_cache_put(cache_dir, key, bio_factors, png, max_bytes=500 * 2**20):
+    '''
+    stores a Cistrome result, then removes the least recently used results until the cache is within max_bytes
+
+        param cache_dir: cache directory, str
+        param key: output of cistrome_cache_key, str
+        param bio_factors: biosample associated factors, dict
+        param png: the result plot, png bytes
+        param max_bytes: the largest the cache can be, in bytes, int
+
+        return: none
+    '''
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # the .json is written last, since cistrome_cache_get needs both files
+    with open(os.path.join(cache_dir, f'{key}.png'), 'wb') as file:
+        file.write(png)
+    with open(os.path.join(cache_dir, f'{key}.json'), 'w') as file:
+        json.dump(bio_factors, file)
+
+    evict_lru(cache_dir, max_bytes, ('.json', '.png'), keep=key) # never evicting the result just stored
+
+    return
+
+def chrome_driver(driver_path=None):
+    '''
+    creates a headless Chrome driver with the settings used for Cistrome
+
+        param driver_path: path of chromedriver, if None it is installed by ChromeDriverManager, str
+
+        return: the driver, selenium webdriver
+    '''
+
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+    from webdriver_manager.chrome import ChromeDriverManager
+
+    # chrome options
+    options = Options()
+    options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+    options.add_argument("--headless")  
+    options.add_argument("--incognito")
+    options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    options.add_experimental_option('useAutomationExtension', False)
+
+    if driver_path is None:
+        driver_path = ChromeDriverManager().install()
+
+    return webdriver.Chrome(service=Service(driver_path), options=options)
+
+class DriverPool:
+    '''
+    a bounded pool of browser sessions, created as needed and reused across traits
+
+        param n_drivers: the most sessions open at once, int
+        param driver_factory: function returning a new webdriver, if None chrome_driver is used
+    '''
+
+    def __init__(self, n_drivers=1, driver_factory=None):
+        self.n_drivers = n_drivers
+        self.driver_factory = driver_factory
+        self.idle = queue.Queue()
+        self.drivers = []
+        self.lock = threading.Lock()
+        self.driver_path = None
+
+    def acquire(self):
+        '''
+        gets an idle driver, creating one if fewer than n_drivers exist, otherwise waits for one to be released
+        '''
+        while True:
+            with self.lock:
+                if self.idle.empty() and len(self.drivers) < self.n_drivers:
+                    driver = self.new_driver()
+                    self.drivers.append(driver)
+                    return driver
+            driver = self.idle.get()
+            if driver is not None: # None marks a driver that was quit, so a new one can be created
+                return driver
+
+    def release(self, driver):
+        '''
+        returns a driver to the pool, or None in place of a driver that was quit
+        '''
+        self.idle.put(driver)
+
+    def run(self, func, *args):
+        '''
+        runs func(driver, *args) on a pooled driver, resetting the driver if func fails
+        '''
+        driver = self.acquire()
+        try:
+            result = func(driver, *args)
+        except Exception:
+            driver = self.reset(driver)
+            raise
+        finally:
+            self.release(driver)
+        return result
+
+    def reset(self, driver):
+        '''
+        returns a driver that failed part way to a single tab outside of any iframe, 
+        or quits it if it can't be reset, so that the pool creates a new one in its place
+
+            return: the driver, or None if it was quit
+        '''
+        try:
+            for handle in driver.window_handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+            driver.switch_to.default_content()
+            return driver
+        except Exception:
+            with self.lock:
+                self.drivers.remove(driver)
+            try:
+                driver.quit()
+            except Exception: # a driver that already crashed can't be quit
+                pass
+            return None
+
+    def new_driver(self):
+        '''
+        creates a driver, only installing chromedriver once per pool
+        '''
+        if self.driver_factory is not None:
+            return self.driver_factory()
+        if self.driver_path is None:
+            from webdriver_manager.chrome import ChromeDriverManager
+            self.driver_path = ChromeDriverManager().install()
+        return chrome_driver(self.driver_path)
+
+    def close(self):
+        '''
+        quits every driver in the pool
+        '''
+        for driver in self.drivers:
+            try:
+                driver.quit()
+            except Exception: # a driver that already crashed can't be quit
+                pass
+        self.drivers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def get_pos(probe_data, ref_data, drop_undef=True, bulk=False, chain_path=None, cache_path=None):
     '''
     gets genetic information from illumina reference table, as provided, and prints out BED information
 
         param probe_data: data from which assessed probe names are derived, requires index to be probe names, df
         param ref_data: data indicating the position of probes, df
         param drop_undef: if True, drop undefined probes
+        param bulk: if True, joins all probes to ref_data at once and lifts them by chromosome through a chain index
+            (see get_pos_bulk), rather than one probe at a time, bool
+        param chain_path: for bulk, mm39 to mm10 chain file, if None the file used by liftover, str
+        param cache_path: for bulk, file to cache converted positions in, reused on later calls, str
 
         return: probe_data with chromosome and position added as columns, df
     '''
 
+    from liftover import get_lifter
+
+    if bulk:
+        return get_pos_bulk(probe_data, ref_data, drop_undef, chain_path, cache_path)
+
     chr_mm39 = []
     pos_mm39 = []
 
@@ -307,16 +650,243 @@ def get_pos(probe_data, ref_data, drop_undef=True):
 
     return probe_data
 
-def screenshot(driver):
+def get_pos_bulk(probe_data, ref_data, drop_undef=True, chain_path=None, cache_path=None):
     '''
-    generates a screenshot corresponding to the current state of the driver
+    vectorized get_pos- joins the probes to ref_data in one step, then lifts the positions of each chromosome 
+    at once through a sorted chain interval index; probes without a defined position or mm10 equivalent are nan
+    positions covered by more than one chain (see lift_positions) are converted by liftover as in get_pos, taking its first hit
+
+        param probe_data: data from which assessed probe names are derived, requires index to be probe names, df
+        param ref_data: data indicating the position of probes, df
+        param drop_undef: if True, drop undefined probes
+        param chain_path: mm39 to mm10 chain file, if None the file used by liftover, str
+        param cache_path: file (.pkl) to cache converted positions in, only probes not already cached are converted, 
+            the cache is discarded if ref_data or the chain file changed, str
+
+        return: probe_data with chromosome and position added as columns, positions as nullable integers, df
+    '''
+
+    chain_path = chain_file(chain_path)
+
+    cached = None
+    if cache_path is not None:
+        inputs = position_inputs_key(ref_data, chain_path)
+        if os.path.exists(cache_path):
+            cached = pd.read_pickle(cache_path)
+            # caches from other inputs, or from before the inputs were stored, are converted again
+            cached = cached['positions'] if isinstance(cached, dict) and (cached.get('inputs') == inputs) else None
+    if cached is not None:
+        to_convert = probe_data.index[~probe_data.index.isin(cached.index)]
+    else:
+        to_convert = probe_data.index
+
+    # join the probes to the manifest, then treat missing positions as undefined
+    bed_data = ref_data.reindex(to_convert)[['chr', 'start']]
+    chrom = bed_data['chr'].astype(str)
+    pos = pd.to_numeric(bed_data['start'], errors='coerce')
+    defined = (chrom != 'nan') & pos.notna()
+
+    converted = pd.DataFrame(index=to_convert)
+    converted['chr_mm39'] = chrom.where(defined)
+    converted['pos_mm39'] = pos.where(defined)
+
+    # lift each chromosome at once
+    chain_index = load_chain_index(chain_path)
+    chr_mm10 = pd.Series(np.nan, index=to_convert, dtype=object)
+    pos_mm10 = pd.Series(np.nan, index=to_convert)
+    converter = None
+    for chr_name, group in converted[defined].groupby('chr_mm39'):
+        positions = group['pos_mm39'].values.astype(np.int64)
+        lifted_chr, lifted_pos, overlapped = lift_positions(chain_index, chr_name, positions)
+
+        # the few positions in overlapping chains are converted one at a time
+        if overlapped.any():
+            if converter is None:
+                from liftover import get_lifter
+                converter = get_lifter(chain_path, one_based=True)
+            for k in np.flatnonzero(overlapped):
+                hits = converter[chr_name][int(positions[k])]
+                if hits:
+                    lifted_chr[k], lifted_pos[k] = hits[0][0], hits[0][1]
+
+        chr_mm10[group.index] = lifted_chr
+        pos_mm10[group.index] = lifted_pos
+    converted['chr_mm10'] = chr_mm10
+    converted['pos_mm10'] = pos_mm10
+    converted[['pos_mm39', 'pos_mm10']] = converted[['pos_mm39', 'pos_mm10']].round().astype('Int64') # so the BED files get integer positions
+
+    if cached is not None:
+        converted = pd.concat([cached, converted])
+    if cache_path is not None:
+        pd.to_pickle({'inputs': inputs, 'positions': converted}, cache_path)
+
+    converted = converted[~converted.index.duplicated(keep='last')].reindex(probe_data.index)
+
+    probe_data['chr_mm39'] = converted['chr_mm39']
+    probe_data['pos_mm39'] = converted['pos_mm39']
+    probe_data['end_mm39'] = probe_data['pos_mm39']+2
+
+    probe_data['chr_mm10'] = converted['chr_mm10']
+    probe_data['pos_mm10'] = converted['pos_mm10']
+    probe_data['end_mm10'] = probe_data['pos_mm10']+2
+
+    if drop_undef:
+        probe_data = probe_data.dropna()
+
+    return probe_data
+
+def position_inputs_key(ref_data, chain_path):
+    '''
+    gets the key of the inputs that converted positions depend on, for the cache of get_pos_bulk
+
+        param ref_data: data indicating the position of probes, df
+        param chain_path: mm39 to mm10 chain file, str
+
+        return: sha256 hex digest, str
+    '''
+
+    sha = hashlib.sha256()
+    sha.update(pd.util.hash_pandas_object(ref_data[['chr', 'start']].astype(str), index=True).values.tobytes())
+    sha.update(file_hash(chain_path).encode())
+
+    return sha.hexdigest()
+
+def chain_file(chain_path=None):
+    '''
+    gets the path of the chain file used by get_pos_bulk
+
+        param chain_path: chain file, if None the mm39 to mm10 file used by liftover, looked up where liftover keeps it 
+            (its cache directory, then the legacy ~/.liftover), and only downloaded if in neither, str
+
+        return: path of the chain file, str
+    '''
+
+    if chain_path is None:
+        from liftover import get_lifter, default_cache_dir
+
+        name = 'mm39ToMm10.over.chain.gz'
+        for cache_dir in (default_cache_dir(), os.path.expanduser(os.path.join('~', '.liftover'))):
+            chain_path = os.path.join(cache_dir, name)
+            if os.path.exists(chain_path) and os.path.getsize(chain_path) > 0:
+                return chain_path
+
+        chain_path = os.path.join(default_cache_dir(), name)
+        get_lifter('mm39', 'mm10') # downloads the chain file to the cache directory, as in get_pos
+
+    return chain_path
+
+def load_chain_index(chain_path=None):
+    '''
+    builds a sorted interval index of the aligned blocks in a chain file, cached as '<chain_path>.index.npz'
+    blocks of different chains can overlap on the source assembly, so the sorted block ends are kept as well, 
+    to count the blocks covering a position (see lift_positions)
+
+        param chain_path: chain file (.chain or .chain.gz), if None the mm39 to mm10 file used by liftover, 
+            downloaded if not present, str
+
+        return: per source chromosome, arrays of the block starts/ends, the sorted ends and their destination, dict
+    '''
+
+    chain_path = chain_file(chain_path)
+
+    index_path = chain_path + '.index.npz'
+    if (not os.path.exists(index_path)) or (os.path.getmtime(index_path) < os.path.getmtime(chain_path)):
+        blocks = {'t_chr': [], 't_start': [], 't_end': [], 'q_chr': [], 'q_start': [], 'q_minus': [], 'q_size': []}
+
+        opener = gzip.open if chain_path.endswith('.gz') else open
+        with opener(chain_path, 'rt') as file:
+            for line in file:
+                fields = line.split()
+                if not fields:
+                    continue
+                if fields[0] == 'chain': # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+                    t_chr, t_pos = fields[2], int(fields[5])
+                    q_chr, q_size, q_minus, q_pos = fields[7], int(fields[8]), fields[9] == '-', int(fields[10])
+                    continue
+
+                # aligned block: size [gap in source, gap in destination]
+                size = int(fields[0])
+                for key, val in zip(blocks, (t_chr, t_pos, t_pos + size, q_chr, q_pos, q_minus, q_size)):
+                    blocks[key].append(val)
+                if len(fields) == 3:
+                    t_pos += size + int(fields[1])
+                    q_pos += size + int(fields[2])
+
+        blocks = {key: np.array(val) for key, val in blocks.items()}
+        order = np.lexsort((blocks['t_start'], blocks['t_chr']))
+        np.savez(index_path, **{key: val[order] for key, val in blocks.items()})
+
+    blocks = np.load(index_path)
+    blocks = {key: blocks[key] for key in blocks.files}
+
+    # split into chromosomes, each already sorted by start
+    chr_names, chr_starts = np.unique(blocks['t_chr'], return_index=True)
+    chr_stops = list(chr_starts[1:]) + [len(blocks['t_chr'])]
+    chain_index = {}
+    for name, start, stop in zip(chr_names, chr_starts, chr_stops):
+        chain_index[str(name)] = {key: val[start:stop] for key, val in blocks.items() if key != 't_chr'}
+        chain_index[str(name)]['sorted_end'] = np.sort(chain_index[str(name)]['t_end'])
+
+    return chain_index
+
+def lift_positions(chain_index, chr_name, positions):
+    '''
+    converts one-based positions on a single chromosome through the chain index of load_chain_index
+
+        param chain_index: output of load_chain_index, dict
+        param chr_name: source chromosome, with or without the 'chr' prefix, str
+        param positions: one-based source positions, numpy array
+
+        return: destination chromosomes and one-based positions, nan where there is no conversion or it is overlapped, 
+            and whether each position is covered by more than one block, or only by a block other than the last to start 
+            before it, so that it has to be converted by liftover instead, numpy arrays
+    '''
+
+    lifted_chr = np.full(len(positions), np.nan, dtype=object)
+    lifted_pos = np.full(len(positions), np.nan)
+    overlapped = np.zeros(len(positions), dtype=bool)
+
+    chr_name = str(chr_name)
+    if chr_name not in chain_index: # with or without the 'chr' prefix, as in liftover
+        chr_name = chr_name[3:] if chr_name.startswith('chr') else 'chr' + chr_name
+    if chr_name not in chain_index:
+        return lifted_chr, lifted_pos, overlapped
+    blocks = chain_index[chr_name]
+
+    # the number of blocks covering each position, every block that ends at or before a position also starts before it
+    zero_based = positions - 1
+    n_started = np.searchsorted(blocks['t_start'], zero_based, side='right')
+    n_covering = n_started - np.searchsorted(blocks['sorted_end'], zero_based, side='right')
+
+    # with a single covering block, it's the last block starting at or before the position, unless the blocks overlap
+    i = n_started - 1
+    found = (n_covering == 1) & (zero_based < blocks['t_end'][np.maximum(i, 0)])
+    overlapped = (n_covering > 0) & ~found
+    i = i[found]
+
+    q_pos = blocks['q_start'][i] + (zero_based[found] - blocks['t_start'][i])
+    q_pos = np.where(blocks['q_minus'][i], blocks['q_size'][i] - q_pos - 1, q_pos) # report on the + strand
+
+    lifted_chr[found] = blocks['q_chr'][i]
+    lifted_pos[found] = q_pos + 1
+
+    return lifted_chr, lifted_pos, overlapped
+
+def screenshot(driver, timeout=10, path='screenshot.png'):
+    '''
+    generates a screenshot corresponding to the current state of the driver, once the page has loaded
         param driver: the driver to assess
+        param timeout: the longest to wait for the page to load, in seconds, float
+        param path: path of the screenshot, give each driver its own when used concurrently, str
 
         return: none
     '''
-    time.sleep(3)
+
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    WebDriverWait(driver, timeout).until(lambda d: d.execute_script('return document.readyState') == 'complete')
     driver.set_window_size(1024, 600)
-    driver.save_screenshot('screenshot.png')
+    driver.save_screenshot(path)
     return
 
 def insig_nan(data):
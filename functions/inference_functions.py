@@ -0,0 +1,130 @@
+'''
+functions that export a trained death prediction model and score inputs with it, without the training stack
+
+the exported model is a frozen TorchScript module, so scoring only needs torch, not death_prediction_functions
+'''
+import numpy as np
+import pandas as pd
+
+import json
+
+
+def export_model(model, path, columns=None):
+    '''
+    exports a trained model as a frozen TorchScript module
+
+        param model: trained neural network, e.g. from train_nn, pytorch object
+        param path: path of the exported model, e.g. 'model.pt', str
+        param columns: input columns, in the order the model was trained on, stored with the model, list
+
+        return: none
+    '''
+    import torch
+
+    model.eval()
+    example = torch.zeros(1, model.fc1.in_features)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(model, example))
+
+    extra_files = {'columns.json': json.dumps(list(columns) if columns is not None else None)}
+    torch.jit.save(scripted, path, _extra_files=extra_files)
+
+    return
+
+def load_model(path):
+    '''
+    loads a model exported by export_model
+
+        param path: path of the exported model, str
+
+        return: the model, TorchScript module, and its input columns, list or None
+    '''
+    import torch
+
+    extra_files = {'columns.json': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    model.eval()
+
+    return model, json.loads(extra_files['columns.json'] or 'null')
+
+def iter_input_chunks(source, chunk_size=65536, columns=None):
+    '''
+    yields the model inputs in chunks of rows, so that the full input never has to be held in memory
+
+        param source: input values, n = samples, either a df, a path to a .npy file (memory mapped),
+            a path to a .csv file or a .parquet file (read in chunks), or an iterable of chunks (dfs or numpy arrays)
+        param chunk_size: number of rows per chunk, for dfs and files, int
+        param columns: input columns to select, in model order, for dfs, .csv and .parquet files, list
+
+        return: generator of chunks, float32 numpy arrays
+    '''
+
+    if isinstance(source, pd.DataFrame):
+        if columns is not None:
+            source = source[columns]
+        for start in range(0, source.shape[0], chunk_size):
+            yield source.iloc[start:start + chunk_size].values.astype('float32')
+        return
+
+    if isinstance(source, str) and source.endswith('.npy'):
+        values = np.load(source, mmap_mode='r') # only the rows being read are loaded
+        for start in range(0, values.shape[0], chunk_size):
+            yield np.array(values[start:start + chunk_size], dtype='float32') # copied, since torch can't wrap read-only memory
+        return
+
+    if isinstance(source, str) and source.endswith('.csv'):
+        for chunk in pd.read_csv(source, usecols=columns, chunksize=chunk_size):
+            yield (chunk[columns] if columns is not None else chunk).values.astype('float32')
+        return
+
+    if isinstance(source, str) and source.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('reading .parquet files requires pyarrow')
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas().values.astype('float32')
+        return
+
+    # otherwise an iterable of chunks
+    for chunk in source:
+        if isinstance(chunk, pd.DataFrame):
+            chunk = chunk[columns] if columns is not None else chunk
+            chunk = chunk.values
+        yield np.asarray(chunk, dtype='float32')
+
+def score(model, source, chunk_size=65536, columns=None, out_path=None):
+    '''
+    gets predictions for input values chunk by chunk, see iter_input_chunks
+
+        param model: exported model from load_model, or a trained neural network, pytorch object
+        param source: input values, see iter_input_chunks
+        param chunk_size: number of rows scored at once, bounds the memory used, int
+        param columns: input columns to select, in model order, list
+        param out_path: path of a .npy file to stream the predictions to, if None they're returned, str
+
+        return: n predictions, n x 1 as in generate_nn_pred, numpy array, or the number of predictions written to out_path, int
+    '''
+    import torch
+
+    model.eval()
+    chunks = iter_input_chunks(source, chunk_size=chunk_size, columns=columns)
+
+    if out_path is None:
+        with torch.inference_mode():
+            outputs = [model(torch.from_numpy(chunk)).numpy() for chunk in chunks]
+        return np.concatenate(outputs) if outputs else np.empty((0, 1), dtype='float32')
+
+    # written as raw float32, then given the .npy header once the number of rows is known
+    from data_loading_functions import raw_to_npy
+
+    n_rows = 0
+    raw_path = out_path + '.raw'
+    with open(raw_path, 'wb') as raw_file, torch.inference_mode():
+        for chunk in chunks:
+            outputs = model(torch.from_numpy(chunk)).numpy().astype('float32').ravel()
+            raw_file.write(outputs.tobytes())
+            n_rows += outputs.shape[0]
+    raw_to_npy(raw_path, out_path, 1)
+
+    return n_rows
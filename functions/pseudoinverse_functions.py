@@ -1,14 +1,23 @@
 '''
 General and misc. functions that help with data management
-'''
-from scipy import stats
-import statsmodels.api as sm
-import statsmodels.stats as sms
-from sklearn.metrics import mean_absolute_error
 
+scipy and statsmodels are imported by the functions that use them, since they are slow to import
+'''
 import numpy as np
 import pandas as pd
 
+import os
+import time
+import contextlib
+import hashlib
+import inspect
+import pickle
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from data_loading_functions import raw_to_npy, evict_lru
+
+STAGE_CACHE_VERSION = 1 # part of every cached_stage key, increase it to invalidate results after changes outside of these modules
  
 def quality_filter(data, filter, keep_val=['Rank', 'CD1 or C57BL6J?', 'C57BL6J or Sv129Ev?']):
     '''
@@ -21,30 +30,8 @@ def quality_filter(data, filter, keep_val=['Rank', 'CD1 or C57BL6J?', 'C57BL6J o
         return: filtered data, df
     '''
 
-    # create a dictionary indicating sort order
-    timepoint_rank_map = {
-        'M16': 0,
-        'M14': 1,
-        'M12': 2,
-        'M10': 3,
-        'M8': 4,
-        'M6': 5,
-        'w20': 6,
-        'w18': 7,
-        'w16': 8,
-        'w15': 9,
-        'w14': 10,
-        'w13': 11,
-        'w12': 12
-    }
-
     # sort data so that later entries are prioritized, since methylation data was collected at M17
-    rank_sort = []
-    for column in data.index:
-        timepoint = column.split('_')[0]
-        # use the mapping to get the rank, defaulting to 13 for unknown timepoints
-        rank = timepoint_rank_map.get(timepoint, 13)
-        rank_sort.append(rank)
+    rank_sort = timepoint_rank(data.index)
 
     # sort the values
     df = data.copy()
@@ -73,15 +60,142 @@ def quality_filter(data, filter, keep_val=['Rank', 'CD1 or C57BL6J?', 'C57BL6J o
 
     return data, masked_corr
 
-def pinv_iteration(trait_data, meth_data, pred_trait=True):
+def timepoint_rank(index):
+    '''
+    gets the sort order of traits by timepoint, so that later timepoints are prioritized by quality_filter
+
+        param index: trait names, prefixed by their timepoint (e.g. M16_...), list
+
+        return: rank of each trait, lower ranks are prioritized, list
+    '''
+
+    # create a dictionary indicating sort order
+    timepoint_rank_map = {
+        'M16': 0,
+        'M14': 1,
+        'M12': 2,
+        'M10': 3,
+        'M8': 4,
+        'M6': 5,
+        'w20': 6,
+        'w18': 7,
+        'w16': 8,
+        'w15': 9,
+        'w14': 10,
+        'w13': 11,
+        'w12': 12
+    }
+
+    rank_sort = []
+    for column in index:
+        timepoint = str(column).split('_')[0]
+        # use the mapping to get the rank, defaulting to 13 for unknown timepoints
+        rank = timepoint_rank_map.get(timepoint, 13)
+        rank_sort.append(rank)
+
+    return rank_sort
+
+def quality_filter_fast(data, filter, keep_val=['Rank', 'CD1 or C57BL6J?', 'C57BL6J or Sv129Ev?'],
+                        greedy=False, block_size=1024):
+    '''
+    equivalent to quality_filter, but ranks once and compares the rows block by block, 
+    so that the full correlation matrix is never built; usable for probe-level redundancy as well as traits
+
+        param data: data to be assessed, by row, df
+        param filter: spearman coefficient threshhold, float
+        param keep_val: which rows to forcefully keep, names not in data are ignored
+        param greedy: if False, a row is dropped if it is similar to any higher priority row, as in quality_filter;
+            if True, it is only compared against the higher priority rows that were kept, bool
+        param block_size: number of rows compared at once, int
+
+        return: filtered data, df, and the highest compared spearman coefficient of each row, in priority order, series
+    '''
+    from scipy import stats
+
+
+    # sort the rows by timepoint priority, the same way as quality_filter
+    order = pd.DataFrame({'rank_sort': timepoint_rank(data.index)}).sort_values(by='rank_sort').index.values
+    names = data.index.values[order]
+
+    # rank each row once, then standardize so that the spearman coefficient is a dot product
+    ranks = stats.rankdata(data.values[order], axis=1)
+    ranks -= ranks.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'): # rows without variance give nan, as they do in pandas
+        Z = ranks / np.sqrt(np.sum(ranks ** 2, axis=1, keepdims=True))
+
+    is_keep = np.isin(names, keep_val)
+    Z_keep = Z[is_keep]
+
+    n_rows = Z.shape[0]
+    dropped = np.zeros(n_rows, dtype=bool)
+    max_corr = np.zeros(n_rows)
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        block = Z[start:stop]
+
+        # kept rows are compared against every kept row, regardless of priority
+        block_max = max_abs_corr(block, Z_keep, block_size)
+
+        # compare against the higher priority rows before this block
+        prev = Z[:start] if not greedy else Z[:start][~dropped[:start]]
+        block_max = np.maximum(block_max, max_abs_corr(block, prev, block_size))
+
+        # compare against the higher priority rows within this block
+        within = np.abs(np.matmul(block, block.T))
+        if greedy: # resolve the block in order, so that dropped rows are ignored by the ones after
+            for i in range(stop - start):
+                earlier_kept = within[i, :i][~dropped[start:start + i]]
+                block_max[i] = np.maximum(block_max[i], earlier_kept.max(initial=0))
+                dropped[start + i] = ~is_keep[start + i] & ~(block_max[i] <= filter) # nan is also dropped, as with dropna
+        else:
+            within[np.triu_indices(stop - start)] = 0 # mask the diagonals and upper triangle
+            block_max = np.maximum(block_max, within.max(axis=1))
+            dropped[start:stop] = ~is_keep[start:stop] & ~(block_max <= filter)
+
+        max_corr[start:stop] = block_max
+
+    max_corr[is_keep] = 0 # rows that can't be removed
+    data = data.loc[data.index.isin(names[~dropped])]
+
+    return data, pd.Series(max_corr, index=names)
+
+def max_abs_corr(block, other, chunk_size=1024):
+    '''
+    gets the highest absolute correlation of each row of block against the rows of other, from standardized rows
+    any nan correlation makes the result nan, so that rows without variance are treated as in quality_filter
+
+        param block: standardized rows, numpy array
+        param other: standardized rows to compare against, numpy array
+        param chunk_size: number of rows of other compared at once, int
+
+        return: highest absolute correlation of each row of block, numpy array
+    '''
+
+    block_max = np.zeros(block.shape[0])
+    for start in range(0, other.shape[0], chunk_size):
+        corr = np.abs(np.matmul(block, other[start:start + chunk_size].T))
+        block_max = np.maximum(block_max, corr.max(axis=1, initial=0)) # maximum propagates nan
+
+    return block_max
+
+def pinv_iteration(trait_data, meth_data, pred_trait=True, closed_form=False, as_array=False,
+                   n_jobs=1, backend='thread', blas_threads=None):
     '''
     utilizes leave 1 out cross validation, gives accuracy of calculation via pseudoinversion by trait
 
         param trait_data: trait-associated data, m = traits, n = animal/individual, df
         param meth_data: methylation score data, m = probe ID, n = animal/individual, df
         pred_trait: determines whether the traits (True) or probes (False) should be the dependent variable
+        closed_form: if True, factorizes the full matrix once and derives each held out prediction from it
+            rather than recomputing the pseudoinverses for every animal, bool
+        as_array: if True, returns the predictions and actual values as 2D arrays rather than dictionaries, bool
+        n_jobs: number of held out animals (folds) to run at once, int
+        backend: whether to run the folds in a pool of threads ('thread') or processes ('process'), 
+            processes read the data from shared memory rather than receiving their own copy, str
+        blas_threads: number of BLAS threads per worker while running folds, if None the BLAS default is kept, int
 
         return: 3 dictionaries- y_train, y_test, index, as dictionaries by index name (site or trait)
+                if as_array = True, 2 arrays (m = animals, n = site or trait) and a list of the site or trait names
 
     '''
 
@@ -106,30 +220,37 @@ def pinv_iteration(trait_data, meth_data, pred_trait=True):
         y = meth_vals.copy()
         y_names = list(meth_data.index)
 
-    # dictionaries for the predictions
-    all_pred = {var: [] for var in y_names}
-    all_actual = {var: [] for var in y_names}
-        
-    for i in range(y.shape[0]): # for every animal
+    n_names = len(y_names) # the bias term is the last column, so it is excluded by only keeping the first n_names
 
-        # define mask to distinguish train and test set
-        mask = np.arange(len(y)) != i
+    if closed_form: # get every held out prediction at once
+        all_pred = closed_form_loo(X, y, pred_trait)[:, :n_names]
+        all_actual = y[:, :n_names]
 
-        # leave out one
-        X_train = X[mask]
-        X_test = X[i]
-        y_train = y[mask]
-        y_test = y[i]
+        if as_array:
+            return all_pred, all_actual, y_names
 
-        # generate predictions 
-        if pred_trait:
-            # this formula is only valid when there are less traits than observations for y_train
-            site_coef = np.matmul(np.linalg.pinv(y_train), X_train) # Coefficient = Pinv(Trait_Train) * Meth_Train
-            pred = np.matmul(X_test, np.linalg.pinv(site_coef)) # Trait_Pred = Meth_Test * Pinv(Site Coef)
+        # sort the predictions into dictionaries by index name
+        return ({var: list(all_pred[:, m]) for m, var in enumerate(y_names)},
+                {var: list(all_actual[:, m]) for m, var in enumerate(y_names)})
 
-        else:
-            site_coef = np.matmul(np.linalg.pinv(X_train), y_train) # Coefficient = Pinv(Trait_Train) * Meth_Train
-            pred = np.matmul(X_test, site_coef) # Meth_Pred = Trait_Test * Site Coef
+    if as_array: # preallocate the arrays for the predictions, one row per animal
+        all_pred = np.zeros((y.shape[0], n_names))
+        all_actual = y[:, :n_names]
+    else: # dictionaries for the predictions
+        all_pred = {var: [] for var in y_names}
+        all_actual = {var: [] for var in y_names}
+        
+    if n_jobs == 1:
+        fold_preds = (loo_fold(X, y, i, pred_trait) for i in range(y.shape[0])) # for every animal
+    else: # the folds are independent, so they can be run at once; results are kept in animal order
+        fold_preds = parallel_folds(X, y, pred_trait, n_jobs, backend, blas_threads)
+
+    for i, pred in enumerate(fold_preds):
+        y_test = y[i]
+
+        if as_array:
+            all_pred[i] = pred[:n_names]
+            continue
 
         # add values to their respective dictionaries
         # note that the bias term is excluded
@@ -139,10 +260,194 @@ def pinv_iteration(trait_data, meth_data, pred_trait=True):
             all_actual[y_names[m]].append(y_test[m])
             m+=1
 
+    if as_array:
+        return all_pred, all_actual, y_names
+
     return all_pred, all_actual
 
+def loo_fold(X, y, i, pred_trait=True):
+    '''
+    runs a single fold of pinv_iteration, with animal i held out
+
+        param X: independent variable, n = animals, numpy array
+        param y: dependent variable, n = animals, numpy array
+        param i: index of the held out animal, int
+        param pred_trait: whether X is the methylation data (True) or the trait data (False), bool
+
+        return: prediction for the held out animal, numpy array
+    '''
+
+    # define mask to distinguish train and test set
+    mask = np.arange(len(y)) != i
+
+    # leave out one
+    X_train = X[mask]
+    X_test = X[i]
+    y_train = y[mask]
+
+    # generate predictions 
+    if pred_trait:
+        # this formula is only valid when there are less traits than observations for y_train
+        site_coef = np.matmul(np.linalg.pinv(y_train), X_train) # Coefficient = Pinv(Trait_Train) * Meth_Train
+        pred = np.matmul(X_test, np.linalg.pinv(site_coef)) # Trait_Pred = Meth_Test * Pinv(Site Coef)
+
+    else:
+        site_coef = np.matmul(np.linalg.pinv(X_train), y_train) # Coefficient = Pinv(Trait_Train) * Meth_Train
+        pred = np.matmul(X_test, site_coef) # Meth_Pred = Trait_Test * Site Coef
+
+    return pred
+
+# arrays attached by each process worker of parallel_folds
+worker_data = {}
+
+def parallel_folds(X, y, pred_trait=True, n_jobs=2, backend='thread', blas_threads=None):
+    '''
+    runs every fold of pinv_iteration in a pool of threads or processes
+
+        param X: independent variable, n = animals, numpy array
+        param y: dependent variable, n = animals, numpy array
+        param pred_trait: whether X is the methylation data (True) or the trait data (False), bool
+        param n_jobs: number of workers, int
+        param backend: 'thread' or 'process', str
+        param blas_threads: number of BLAS threads per worker, if None the BLAS default is kept, int
+
+        return: predictions for every held out animal, in animal order, list
+    '''
+
+    folds = range(y.shape[0])
+
+    if backend == 'thread': # the workers share the arrays and the BLAS pool, so limit the BLAS threads for the whole process
+        with blas_limit(blas_threads), ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(lambda i: loo_fold(X, y, i, pred_trait), folds))
+
+    if backend != 'process':
+        raise ValueError(f"backend must be 'thread' or 'process', not {backend}")
+
+    # copy the arrays into shared memory once, the workers attach to it rather than each receiving a pickled copy
+    shared = []
+    try:
+        specs = []
+        for arr in (X, y):
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            shared.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+            specs.append((shm.name, arr.shape, arr.dtype.str))
+
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_fold_worker,
+                                 initargs=(specs, pred_trait, blas_threads)) as executor:
+            return list(executor.map(run_worker_fold, folds)) # map keeps the fold order
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+def init_fold_worker(specs, pred_trait, blas_threads):
+    '''
+    attaches a process worker of parallel_folds to the shared arrays and sets its BLAS thread count
+
+        param specs: (shared memory name, shape, dtype) of X and y, list
+        param pred_trait: whether X is the methylation data (True) or the trait data (False), bool
+        param blas_threads: number of BLAS threads for this worker, if None the BLAS default is kept, int
+
+        return: none
+    '''
+
+    worker_data['shm'] = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    worker_data['X'], worker_data['y'] = [np.ndarray(shape, dtype=dtype, buffer=shm.buf) 
+                                          for shm, (_, shape, dtype) in zip(worker_data['shm'], specs)]
+    worker_data['pred_trait'] = pred_trait
+
+    # kept for the lifetime of the worker
+    worker_data['blas_limit'] = blas_limit(blas_threads)
+    worker_data['blas_limit'].__enter__()
+    return
+
+def run_worker_fold(i):
+    '''
+    runs fold i of pinv_iteration on the arrays attached by init_fold_worker
+
+        param i: index of the held out animal, int
+
+        return: prediction for the held out animal, numpy array
+    '''
+    return loo_fold(worker_data['X'], worker_data['y'], i, worker_data['pred_trait'])
+
+def blas_limit(n_threads):
+    '''
+    limits the number of BLAS threads within a with block, requires threadpoolctl
+
+        param n_threads: number of BLAS threads, if None nothing is changed, int
+
+        return: context manager
+    '''
+
+    if n_threads is None:
+        return contextlib.nullcontext()
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        raise ImportError('setting blas_threads requires threadpoolctl')
+    return threadpool_limits(limits=n_threads, user_api='blas')
+
+def reduced_basis(X):
+    '''
+    gets the reduced basis of the methylation data used by closed_form_loo, i.e. U * S of its thin SVD
+
+        param X: methylation data, m = animals, n = probes, numpy array
+
+        return: reduced basis, m = animals, n = components, numpy array
+    '''
+    U, S, _ = np.linalg.svd(X, full_matrices=False)
+    return U * S
+
+def closed_form_loo(X, y, pred_trait=True, basis=None):
+    '''
+    gets the leave 1 out predictions of pinv_iteration without refitting the full pseudoinverse for every animal
+
+        param X: independent variable, n = animals, numpy array
+        param y: dependent variable, n = animals, numpy array
+        param pred_trait: whether X is the methylation data (True) or the trait data (False), bool
+        param basis: if pred_trait = True, the output of reduced_basis(X) if already computed, numpy array
+
+        return: held out predictions, m = animals, n = columns of y, numpy array
+    '''
+
+    n_animals = y.shape[0]
+    preds = np.zeros(y.shape)
+
+    if pred_trait:
+        # thin SVD of the methylation matrix, done once; X = L * Vt where Vt has orthonormal rows
+        # for any animal subset, pinv(A * X[mask]) = V * pinv(A * L[mask]), and X[i] * V = L[i]
+        # so each fold only needs a pseudoinverse of a (traits x animals) matrix, never of (traits x probes)
+        L = reduced_basis(X) if basis is None else basis
+
+        for i in range(n_animals):
+            mask = np.arange(n_animals) != i
+            C = np.matmul(np.linalg.pinv(y[mask]), L[mask]) # equivalent to site_coef, in the reduced basis
+            preds[i] = np.matmul(L[i], np.linalg.pinv(C))
+
+    else:
+        # hat matrix identity: the held out residual is the full-fit residual scaled by 1 / (1 - leverage)
+        U, S, _ = np.linalg.svd(X, full_matrices=False)
+        U = U[:, S > S.max() * max(X.shape) * np.finfo(S.dtype).eps] # only the numerically nonzero components
+        leverage = np.sum(U ** 2, axis=1)
+
+        fitted = np.matmul(U, np.matmul(U.T, y))
+        resid = y - fitted
+
+        # an animal with leverage ~1 is not spanned by the others, so the identity is undefined; refit it directly
+        refit = leverage > 1 - 1e-8
+        scale = np.where(refit, 0, 1 / (1 - np.where(refit, 0, leverage)))
+        preds = y - resid * scale[:, None]
+
+        for i in np.flatnonzero(refit):
+            mask = np.arange(n_animals) != i
+            preds[i] = np.matmul(X[i], np.matmul(np.linalg.pinv(X[mask]), y[mask]))
+
+    return preds
+
 def pinv_dropmin(trait_data, meth_data, trait_thresh, 
-                 probe_thresh=0, to_keep = ['Rank']):
+                 probe_thresh=0, to_keep = ['Rank'], incremental=False, return_log=False, cache_dir=None):
     '''
     identifies those traits highly predictable using methylation data,
     and uses this information according to parameter settings
@@ -154,70 +459,135 @@ def pinv_dropmin(trait_data, meth_data, trait_thresh,
         param plot_results: if True, plots results of data analysis, in accordance with other parameters, bool
         param probe_thresh: threshold of mean difference for dropping methylation sites, if val > param, drop
         param to_keep: which traits to keep, as a list
+        param incremental: if True, decomposes the methylation data once and reuses it for every round,
+            rather than rerunning pinv_iteration from scratch after traits are dropped, bool
+        param return_log: if True, also returns a list with one dictionary per round, 
+            containing the round number, traits dropped, round time (s) and correlation values, bool
+        param cache_dir: if set, filter_meth, each round's pinv_iteration and meth_calc are cached there by cached_stage, 
+            so rerunning with the same inputs (or e.g. only a different trait_thresh) reuses their results, str
 
         return: 3 dictionaries- if find_meth = False, keys = traits, vals = model predictions, actual, index,
                             else, keys = probes, vals = pvals+coefs, pvals, coefs 
     '''
+    from scipy import stats
+
+    def stage(func, *args, **kwargs): # runs the stage, through the cache if there is one
+        if cache_dir is None:
+            return func(*args, **kwargs)
+        return cached_stage(func, *args, cache_dir=cache_dir, **kwargs)
 
     if probe_thresh != 0: # decrease number of methylation probes
-        meth_data = filter_meth(trait_data, meth_data, probe_thresh)
+        meth_data = stage(filter_meth, trait_data, meth_data, probe_thresh)
+
+    if incremental: # the methylation decomposition doesn't depend on the traits, so only do it once
+        meth_vals = meth_data.T.values
+        basis = reduced_basis(meth_vals)
 
+    round_log = []
     any_dropped = True # to initiate the loop
     while any_dropped:
-
-        pred, actual = pinv_iteration(trait_data, meth_data)
+        round_start = time.perf_counter()
+
+        if incremental: # only the (traits x animals) pseudoinverses are recomputed for the remaining traits
+            trait_vals = trait_data.T.copy()
+            trait_vals['bias_term'] = 1
+            trait_vals = trait_vals.values
+            trait_names = list(trait_data.index)
+            pred = closed_form_loo(meth_vals, trait_vals, basis=basis)[:, :len(trait_names)]
+            actual = trait_vals[:, :len(trait_names)]
+        else:
+            pred, actual, trait_names = stage(pinv_iteration, trait_data, meth_data, as_array=True)
         any_dropped = False # none have been dropped yet
 
         to_remove = []
-        for key in pred.keys():
+        round_corr = {}
+        for m, key in enumerate(trait_names):
             if key in to_keep: # skip the traits which are being forcefully maintained
                 continue
-            corr = stats.spearmanr(pred[key], actual[key]) # get the prediction accuracy
+            corr = stats.spearmanr(pred[:, m], actual[:, m]) # get the prediction accuracy
+            round_corr[key] = corr[0]
             if abs(corr[0]) < trait_thresh: # if the absolute value of the correlation coefficient is under the threshhold
                 to_remove.append(key) # prepare to drop the poorly predicted traits
                 any_dropped = True # tells us that some have been dropped, so we should continue running iterations
         trait_data = trait_data.drop(index=to_remove) # drop the poorly predicted traits
 
+        round_log.append({'round': len(round_log), 'dropped': to_remove,
+                          'time': time.perf_counter() - round_start, 'correlations': round_corr})
+
+    # sort the final predictions into dictionaries by trait name
+    pred = {key: list(pred[:, m]) for m, key in enumerate(trait_names)}
+    actual = {key: list(actual[:, m]) for m, key in enumerate(trait_names)}
+
     # get the pvalues and coefficients for each trait/site combination
-    trait_pvals, trait_vals = meth_calc(trait_data, meth_data)
-    
+    trait_pvals, trait_vals = stage(meth_calc, trait_data, meth_data)
+
+    if return_log:
+        return pred, actual, trait_vals, trait_pvals, round_log
     return pred, actual, trait_vals, trait_pvals
 
-def filter_meth(trait_data, meth_data, thresh=0.5):
+def filter_meth(trait_data, meth_data, thresh=0.5, chunk_size=None, return_scores=False):
     '''
     filters methylation data, removing those probes which do not vary significantly between individuals
 
         param trait_data: trait-associated data, m = traits, n = animal/individual, df
         param meth_data: methylation score data, m = probe ID, n = animal/individual, df
         param thresh: threshold for dropping probes, if mean absolute error (actual vs predicted) / std, drop
+        param chunk_size: number of probes scored at once, if None all probes are scored together, int
+        param return_scores: whether to also return the score of every probe, bool
 
         return: filtered methylation data, df
+                if return_scores = True, also the mean absolute error / std of every probe, in the order of meth_data, numpy array
     '''
 
-    pred, actual = pinv_iteration(trait_data, meth_data, pred_trait=False)
+    pred, actual, _ = pinv_iteration(trait_data, meth_data, pred_trait=False, as_array=True)
+    scores = score_probes(pred, actual, chunk_size)
 
-    to_remove = []
-    for key in pred.keys():
-        temp = (mean_absolute_error(actual[key], pred[key]) / np.std(actual[key])) # mean abs error / std
-        if temp >= thresh: # i.e keep those <thresh
-            to_remove.append(key)
-        else:
-            pass
+    # remove the probes with poor predication accuracy, i.e keep those <thresh
+    meth_data = meth_data[~(scores >= thresh)]
 
-    # remove the probes with poor predication accuracy
-    meth_data = meth_data.drop(to_remove)
+    if return_scores:
+        return meth_data, scores
     return meth_data
 
-def meth_calc(trait_data, meth_data):
+def score_probes(pred, actual, chunk_size=None):
+    '''
+    gets the mean absolute error / std of the predictions for every probe
+
+        param pred: predicted values, m = animals, n = probes, numpy array
+        param actual: actual values, m = animals, n = probes, numpy array
+        param chunk_size: number of probes scored at once, if None all probes are scored together, int
+
+        return: score of every probe, numpy array
+    '''
+
+    n_probes = actual.shape[1]
+    if chunk_size is None:
+        chunk_size = max(n_probes, 1)
+
+    scores = np.zeros(n_probes)
+    with np.errstate(divide='ignore', invalid='ignore'): # probes without variance get inf or nan, as they did with sklearn
+        for start in range(0, n_probes, chunk_size):
+            stop = start + chunk_size
+            mae = np.mean(np.abs(actual[:, start:stop] - pred[:, start:stop]), axis=0)
+            scores[start:stop] = mae / np.std(actual[:, start:stop], axis=0)
+
+    return scores
+
+def meth_calc(trait_data, meth_data, batched=False):
     '''
     runs MLR, X (dependent) = probes, y (independent) = traits
     gets AdjP for each trait/probe combination
     
         param trait_data: trait-associated data, m = traits, n = animal/individual, df
         param meth_data: methylation score data, m = probe ID, n = animal/individual, df
+        param batched: if True, fits every probe at once from a single factorization of the shared design matrix
+            rather than fitting one OLS model per probe, bool
 
         return: 2 dictionaries- keys = traits, vals = model pvals, model coefficients
     '''
+    import statsmodels.api as sm
+    import statsmodels.stats as sms
+
     meth_index = list(meth_data.index)
     trait_names = list(trait_data.index)
 
@@ -232,10 +602,16 @@ def meth_calc(trait_data, meth_data):
     # add a constant term to trait_vals so that the model is fit through an origin of 1
     X = sm.add_constant(trait_vals, prepend=True) # adds to the first column
     
-    for i, probe in enumerate(meth_vals): # get p values for all probe-trait combinations (i.e. the "multiple" in multiple linear regression)
-        model = sm.OLS(probe, X).fit() #  the "linear" in multiple linear regression
-        pvals[i] = model.pvalues[1:] # get the p values from the OLS, excluding the intercept
-        coef[i] =  model.params[1:]
+    if batched: # every probe is a column of the response, so they share the factorization of X
+        params, _, _, model_pvals = batched_ols(X, meth_vals.T)
+        pvals[:] = model_pvals[1:].T # excluding the intercept
+        coef[:] = params[1:].T
+
+    else:
+        for i, probe in enumerate(meth_vals): # get p values for all probe-trait combinations (i.e. the "multiple" in multiple linear regression)
+            model = sm.OLS(probe, X).fit() #  the "linear" in multiple linear regression
+            pvals[i] = model.pvalues[1:] # get the p values from the OLS, excluding the intercept
+            coef[i] =  model.params[1:]
 
     # so that we can iterate by trait
     pvals_by_trait = pvals.T
@@ -265,6 +641,348 @@ def meth_calc(trait_data, meth_data):
 
     return trait_pvals, trait_all_vals
 
+def batched_ols(X, Y):
+    '''
+    fits an OLS model to every column of Y using the same design matrix, equivalent to sm.OLS(Y[:, i], X).fit()
+
+        param X: design matrix, including the constant, m = observations, n = parameters, numpy array
+        param Y: responses, m = observations, n = models (e.g. probes), numpy array
+
+        return: coefficients, standard errors, t values, p values, m = parameters, n = models, numpy arrays
+    '''
+    from scipy import stats, linalg
+
+
+    n_obs, n_params = X.shape
+    rank = np.linalg.matrix_rank(X)
+
+    if rank == n_params: # factorize X once, X = QR
+        Q, R = np.linalg.qr(X)
+        params = linalg.solve_triangular(R, np.matmul(Q.T, Y))
+        R_inv = linalg.solve_triangular(R, np.eye(n_params))
+        cov_diag = np.sum(R_inv ** 2, axis=1) # diagonal of inv(X'X) = inv(R) * inv(R)'
+    else: # rank deficient, so use the pseudoinverse as statsmodels does
+        X_pinv = np.linalg.pinv(X)
+        params = np.matmul(X_pinv, Y)
+        cov_diag = np.sum(X_pinv ** 2, axis=1)
+
+    # residual variance of each model
+    df_resid = n_obs - rank
+    resid = Y - np.matmul(X, params)
+    scale = np.sum(resid ** 2, axis=0) / df_resid
+
+    with np.errstate(divide='ignore', invalid='ignore'): # perfect fits give nan, as they do in statsmodels
+        bse = np.sqrt(np.outer(cov_diag, scale))
+        tvals = params / bse
+    pvals = stats.t.sf(np.abs(tvals), df_resid) * 2
+
+    return params, bse, tvals, pvals
+
+def iter_probe_blocks(meth_source, block_size=10000, probe_names=None):
+    '''
+    yields the methylation data in blocks of probes, so that the full matrix never has to be held in memory
+
+        param meth_source: methylation score data, m = probe ID, n = animal/individual, either a df,
+            a path to a .npy file (memory mapped), a path to a .parquet file (read by row group),
+            or an iterable of blocks (dfs or numpy arrays)
+        param block_size: number of probes per block, for dfs and .npy files, int
+        param probe_names: probe IDs for .npy files and numpy array blocks, if None the probes are numbered, list
+
+        return: generator of (probe names, block values) pairs, block values are m = probes, n = animals
+    '''
+
+    if isinstance(meth_source, pd.DataFrame):
+        for start in range(0, meth_source.shape[0], block_size):
+            block = meth_source.iloc[start:start + block_size]
+            yield list(block.index), block.values
+        return
+
+    if isinstance(meth_source, str) and meth_source.endswith('.npy'):
+        meth_vals = np.load(meth_source, mmap_mode='r') # only the rows being read are loaded
+        for start in range(0, meth_vals.shape[0], block_size):
+            stop = min(start + block_size, meth_vals.shape[0])
+            names = list(probe_names[start:stop]) if probe_names is not None else list(range(start, stop))
+            yield names, np.asarray(meth_vals[start:stop])
+        return
+
+    if isinstance(meth_source, str) and meth_source.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('reading .parquet files requires pyarrow')
+        parquet_file = pq.ParquetFile(meth_source)
+        for i in range(parquet_file.num_row_groups):
+            block = parquet_file.read_row_group(i).to_pandas() # the probe IDs are restored as the index
+            yield list(block.index), block.values
+        return
+
+    # otherwise an iterable of blocks
+    start = 0
+    for block in meth_source:
+        if isinstance(block, pd.DataFrame):
+            names = list(block.index)
+            block = block.values
+        else:
+            block = np.asarray(block)
+            stop = start + block.shape[0]
+            names = list(probe_names[start:stop]) if probe_names is not None else list(range(start, stop))
+        start += block.shape[0]
+        yield names, block
+
+def filter_meth_stream(trait_data, meth_source, out_dir, thresh=0.5, block_size=10000, probe_names=None):
+    '''
+    equivalent to filter_meth, but reads the methylation data by block and writes the kept probes as it goes
+    peak memory is determined by block_size rather than the number of probes
+
+        param trait_data: trait-associated data, m = traits, n = animal/individual, df
+        param meth_source: methylation score data, m = probe ID, n = animal/individual, see iter_probe_blocks
+        param out_dir: directory to write filtered_meth.npy (float32, m = probe, n = animal) and filtered_probes.txt to, str
+        param thresh: threshold for dropping probes, if mean absolute error (actual vs predicted) / std, drop
+        param block_size: number of probes per block, int
+        param probe_names: probe IDs, see iter_probe_blocks, list
+
+        return: the kept probe IDs, list, and the score of every probe, numpy array
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    raw_path = os.path.join(out_dir, 'filtered_meth.raw')
+
+    # the trait matrix, with the constant, is shared by every block
+    trait_vals = trait_data.T.copy()
+    trait_vals['bias_term'] = 1
+    trait_vals = trait_vals.values
+
+    kept_probes = []
+    scores = []
+    with open(raw_path, 'wb') as meth_file, open(os.path.join(out_dir, 'filtered_probes.txt'), 'w') as name_file:
+        for names, block in iter_probe_blocks(meth_source, block_size, probe_names):
+            # each probe is predicted independently, so the held out predictions can be made by block
+            y = block.T.astype('float64')
+            block_scores = score_probes(closed_form_loo(trait_vals, y, pred_trait=False), y)
+            scores.append(block_scores)
+
+            keep = ~(block_scores >= thresh)
+            block[keep].astype('float32').tofile(meth_file)
+            kept_names = [name for name, k in zip(names, keep) if k]
+            name_file.writelines(f'{name}\n' for name in kept_names)
+            kept_probes.extend(kept_names)
+
+    raw_to_npy(raw_path, os.path.join(out_dir, 'filtered_meth.npy'), trait_vals.shape[0])
+
+    return kept_probes, np.concatenate(scores) if scores else np.zeros(0)
+
+def meth_calc_stream(trait_data, meth_source, out_dir, block_size=10000, probe_names=None):
+    '''
+    equivalent to meth_calc, but reads the methylation data by block and writes the results as it goes
+    the FDR correction is applied at the end, over the collected p values of each trait
+
+        param trait_data: trait-associated data, m = traits, n = animal/individual, df
+        param meth_source: methylation score data, m = probe ID, n = animal/individual, see iter_probe_blocks
+        param out_dir: directory to write meth_calc_pvals.npy, meth_calc_coefs.npy (float32, m = probe, n = trait)
+            and meth_calc_probes.txt to, str
+        param block_size: number of probes per block, int
+        param probe_names: probe IDs, see iter_probe_blocks, list
+
+        return: 2 dictionaries- keys = traits, vals = model pvals, model coefficients (memory mapped), and the probe IDs, list
+    '''
+    import statsmodels.api as sm
+    import statsmodels.stats as sms
+
+
+    os.makedirs(out_dir, exist_ok=True)
+    trait_names = list(trait_data.index)
+
+    # add a constant term to trait_vals so that the model is fit through an origin of 1
+    X = sm.add_constant(trait_data.values.T, prepend=True)
+    n_traits = X.shape[1] - 1
+
+    pval_raw = os.path.join(out_dir, 'meth_calc_pvals.raw')
+    coef_raw = os.path.join(out_dir, 'meth_calc_coefs.raw')
+
+    all_probes = []
+    with open(pval_raw, 'wb') as pval_file, open(coef_raw, 'wb') as coef_file, \
+         open(os.path.join(out_dir, 'meth_calc_probes.txt'), 'w') as name_file:
+        for names, block in iter_probe_blocks(meth_source, block_size, probe_names):
+            params, _, _, pvals = batched_ols(X, block.T)
+            pvals[1:].T.astype('float32').tofile(pval_file) # excluding the intercept
+            params[1:].T.astype('float32').tofile(coef_file)
+            name_file.writelines(f'{name}\n' for name in names)
+            all_probes.extend(names)
+
+    pval_path = os.path.join(out_dir, 'meth_calc_pvals.npy')
+    coef_path = os.path.join(out_dir, 'meth_calc_coefs.npy')
+    raw_to_npy(pval_raw, pval_path, n_traits)
+    raw_to_npy(coef_raw, coef_path, n_traits)
+
+    pvals = np.load(pval_path, mmap_mode='r+')
+    coefs = np.load(coef_path, mmap_mode='r')
+
+    # adjust the p values by trait, one column in memory at a time
+    trait_pvals = {}
+    trait_coefs = {}
+    for n in range(n_traits):
+        if len(all_probes):
+            pvals[:, n] = sms.multitest.fdrcorrection(pvals[:, n], alpha=0.01)[1]
+        trait_pvals[trait_names[n]] = pvals[:, n]
+        trait_coefs[trait_names[n]] = coefs[:, n]
+    pvals.flush()
+
+    return trait_pvals, trait_coefs, all_probes
+
+def cached_stage(func, *args, cache_dir='pinv_cache', max_mb=2000, refresh=False, **kwargs):
+    '''
+    runs a stage of the pipeline, e.g. quality_filter, filter_meth, pinv_iteration or meth_calc, 
+    or loads its result from cache_dir if it has already been run with the same inputs and code
+
+    results are pickled to <stage name>_<key>.pkl, keyed by stage_key, 
+    and the least recently used results are removed once the cache is larger than max_mb
+
+        param func: the stage, function
+        param args: positional arguments of the stage
+        param cache_dir: cache directory, str
+        param max_mb: the largest the cache can be, in MB, float
+        param refresh: whether to rerun the stage and overwrite its cached result, bool
+        param kwargs: keyword arguments of the stage
+
+        return: the result of func(*args, **kwargs)
+    '''
+
+    key = stage_key(func, args, kwargs)
+    path = os.path.join(cache_dir, f'{func.__name__}_{key}.pkl')
+
+    if os.path.exists(path) and not refresh:
+        with open(path, 'rb') as file:
+            result = pickle.load(file)
+        os.utime(path) # recently used, so evicted last
+        return result
+
+    result = func(*args, **kwargs)
+
+    # written to a temporary file first, so an interrupted write is never mistaken for a result
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + '.tmp', 'wb') as file:
+        pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+    # evict the least recently used results, never the one just stored
+    evict_lru(cache_dir, max_mb * 2**20, ('.pkl',), keep=f'{func.__name__}_{key}')
+
+    return result
+
+def clear_stage_cache(cache_dir='pinv_cache', func=None):
+    '''
+    removes cached results, e.g. after the input files were replaced by ones with identical contents that should be rerun
+
+        param cache_dir: cache directory, str
+        param func: the stage whose results are removed, if None all results are removed, function
+
+        return: number of results removed, int
+    '''
+
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl') and (func is None or name.startswith(f'{func.__name__}_')):
+            os.remove(os.path.join(cache_dir, name))
+            removed += 1
+
+    return removed
+
+def stage_key(func, args, kwargs):
+    '''
+    gets the cache key of a stage, from its name, the source code of its module (so that edits to the functions it calls
+    also count) and STAGE_CACHE_VERSION, and the contents of its arguments
+
+        param func: the stage, function
+        param args: positional arguments, tuple
+        param kwargs: keyword arguments, dict
+
+        return: sha256 hex digest, str
+    '''
+
+    sha = hashlib.sha256()
+    sha.update(f'{func.__name__}|{STAGE_CACHE_VERSION}'.encode())
+    try: # so that editing the stage, or anything else in its module, invalidates its results
+        sha.update(inspect.getsource(inspect.getmodule(func) or func).encode())
+    except (OSError, TypeError):
+        pass
+
+    hash_value(sha, args)
+    hash_value(sha, sorted(kwargs.items()))
+
+    return sha.hexdigest()
+
+def hash_value(sha, value):
+    '''
+    adds the contents of an argument to a hash, for dfs and numpy arrays by their values rather than their repr
+
+        param sha: the hash, hashlib object
+        param value: the argument, e.g. a df, numpy array, float or list
+
+        return: none
+    '''
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        sha.update(type(value).__name__.encode())
+        sha.update(pd.util.hash_pandas_object(value.index).values.tobytes())
+        if isinstance(value, pd.DataFrame):
+            sha.update(pd.util.hash_pandas_object(value.columns).values.tobytes())
+            dtypes = value.dtypes.tolist()
+        else:
+            dtypes = [value.dtype]
+        sha.update(repr(dtypes).encode())
+        if all(dtype.kind in 'biufc' for dtype in dtypes): # numeric, so hashed directly from memory
+            if (len(set(dtypes)) == 1) or isinstance(value, pd.Series):
+                hash_array(sha, value.values)
+            else: # by column, since .values would copy mixed types into one array
+                for i in range(value.shape[1]):
+                    hash_array(sha, value.iloc[:, i].values)
+        else:
+            sha.update(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        sha.update(f'{value.dtype.str}{value.shape}'.encode())
+        hash_array(sha, value)
+    elif isinstance(value, (list, tuple)):
+        sha.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            hash_value(sha, item)
+    elif isinstance(value, dict):
+        hash_value(sha, sorted(value.items(), key=lambda item: repr(item[0])))
+    else:
+        sha.update(repr(value).encode())
+
+    return
+
+def hash_array(sha, array, chunk_bytes=2**26):
+    '''
+    adds the values of a numpy array to a hash without copying it, e.g. the methylation data of every pinv_dropmin round
+
+        param sha: the hash, hashlib object
+        param array: the values, numpy array
+        param chunk_bytes: if the array isn't contiguous, the most bytes copied at once to hash it in chunks, int
+
+        return: none
+    '''
+
+    if array.dtype.kind == 'O': # objects can't be hashed from memory
+        sha.update(pd.util.hash_array(array.ravel()).tobytes())
+        return
+
+    if array.flags.f_contiguous and not array.flags.c_contiguous: # e.g. df.values, hashed in memory order
+        array = array.T
+        sha.update(b'T')
+
+    if array.flags.c_contiguous:
+        sha.update(array.reshape(-1).view(np.uint8))
+    else:
+        rows = max(1, chunk_bytes // max(array[:1].nbytes, 1))
+        for start in range(0, array.shape[0], rows):
+            sha.update(np.ascontiguousarray(array[start:start + rows]).reshape(-1).view(np.uint8))
+
+    return
+
 def count_cumulative_probes(df, col1, col2):
     '''
     Counts the number of non-NaN rows for two specified columns, with overlapping non-NaN rows counted once.
@@ -0,0 +1,138 @@
+'''
+tests cistrome_lookup against the local stand-in pages in cistrome_standin, and the DriverPool reset after a failure
+
+the lookup test needs selenium and a headless Chrome, and is skipped without them
+'''
+import os
+import sys
+import shutil
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'functions'))
+from gene_analysis_functions import cistrome_lookup, DriverPool, chrome_driver, screenshot
+
+STANDIN_DIR = os.path.join(os.path.dirname(__file__), 'cistrome_standin')
+PLOT = b'\x89PNG stand-in plot'
+
+
+@pytest.fixture
+def standin_url(tmp_path):
+    '''
+    serves a copy of the stand-in pages, with the plot, from a local server
+    '''
+    site = tmp_path / 'site'
+    shutil.copytree(STANDIN_DIR, site)
+    (site / 'plot.png').write_bytes(PLOT)
+
+    handler = functools.partial(SimpleHTTPRequestHandler, directory=str(site))
+    handler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/index.html'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def driver():
+    '''
+    a headless Chrome driver, skipping the test if one can't be started
+    '''
+    pytest.importorskip('selenium')
+    try:
+        driver = chrome_driver(os.environ.get('CHROMEDRIVER'))
+    except Exception as error:
+        pytest.skip(f'no headless Chrome available: {error}')
+    yield driver
+    driver.quit()
+
+def test_lookup_standin(standin_url, driver, tmp_path):
+    bed_path = tmp_path / 'trait.bed'
+    bed_path.write_text('chr1\t100\t102\nchr2\t200\t202\n')
+
+    bio_factors, png, timing = cistrome_lookup(driver, str(bed_path), base_url=standin_url, timeout=10, 
+                                               screenshot_dir=str(tmp_path / 'screenshots'))
+
+    assert bio_factors == {'Liver': ['Foxa2', 'Hnf4a'], 'Heart': ['Gata4']}
+    assert png == PLOT
+    assert set(timing) == {'submit', 'wait', 'scrape', 'download'}
+    assert len(driver.window_handles) == 1 # left on a single tab for reuse
+    assert (tmp_path / 'screenshots' / 'trait.png').exists() # named after the BED file
+
+class FakeSwitch:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def window(self, handle):
+        self.driver.current = handle
+
+    def default_content(self):
+        self.driver.in_frame = False
+
+class FakeDriver:
+    '''
+    records the state that DriverPool.reset restores, a second tab and an iframe
+    '''
+    def __init__(self, broken=False):
+        self.window_handles = ['main', 'plot']
+        self.current = 'plot'
+        self.in_frame = True
+        self.broken = broken
+        self.quit_called = False
+        self.switch_to = FakeSwitch(self)
+
+    def close(self):
+        if self.broken:
+            raise RuntimeError('driver crashed')
+        self.window_handles.remove(self.current)
+
+    def quit(self):
+        self.quit_called = True
+
+def failing_lookup(driver):
+    raise RuntimeError('lookup failed')
+
+def test_pool_resets_driver_after_failure():
+    with DriverPool(1, FakeDriver) as pool:
+        with pytest.raises(RuntimeError):
+            pool.run(failing_lookup)
+        driver = pool.acquire()
+
+    assert driver.window_handles == ['main']
+    assert driver.current == 'main'
+    assert not driver.in_frame
+
+def test_pool_replaces_driver_that_cant_be_reset():
+    created = []
+    factory = lambda: created.append(FakeDriver(broken=not created)) or created[-1]
+
+    with DriverPool(1, factory) as pool:
+        with pytest.raises(RuntimeError):
+            pool.run(failing_lookup)
+        driver = pool.acquire()
+
+    assert created[0].quit_called
+    assert driver is created[1]
+
+class FakePage:
+    '''
+    a loaded page that records where screenshot saves to
+    '''
+    def execute_script(self, script):
+        return 'complete'
+
+    def set_window_size(self, width, height):
+        pass
+
+    def save_screenshot(self, path):
+        self.saved = path
+
+def test_screenshot_path(tmp_path):
+    page = FakePage()
+    screenshot(page, timeout=1, path=str(tmp_path / 'trait_0.png'))
+
+    assert page.saved == str(tmp_path / 'trait_0.png')
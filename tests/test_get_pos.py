@@ -0,0 +1,65 @@
+'''
+tests that get_pos_bulk gives liftover's first hit, including where chains overlap on the source assembly
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'functions'))
+from gene_analysis_functions import get_pos_bulk
+
+# chr4 is aligned to itself from 10000 to 40000, overlapped by a chain to chr7 and a minus strand chain to chr9
+OVERLAPPING_CHAIN = '''chain 1000 chr4 100000 + 10000 40000 chr4 100000 + 10000 40000 1
+30000
+
+chain 900 chr4 100000 + 12000 20000 chr7 100000 + 62000 70000 2
+8000
+
+chain 800 chr4 100000 + 25000 28000 chr9 100000 - 1000 4000 3
+3000
+
+'''
+
+
+@pytest.fixture
+def chain_path(tmp_path):
+    pytest.importorskip('liftover') # converts the overlapped positions
+    path = tmp_path / 'overlapping.chain'
+    path.write_text(OVERLAPPING_CHAIN)
+    return str(path)
+
+def positions(chroms, starts):
+    '''
+    the probe and reference data of get_pos for the given source positions
+    '''
+    probes = [f'cg{i:08d}' for i in range(len(starts))]
+    ref_data = pd.DataFrame({'chr': chroms, 'start': [str(start) for start in starts]}, index=probes)
+    probe_data = pd.DataFrame({'coef': np.zeros(len(probes))}, index=probes)
+    return probe_data, ref_data
+
+def test_overlapping_chains(chain_path):
+    probe_data, ref_data = positions(['chr4', 'chr4', 'chr4', '4'], [30000, 15000, 26000, 50000])
+
+    lifted = get_pos_bulk(probe_data, ref_data, drop_undef=False, chain_path=chain_path)
+
+    assert lifted['chr_mm10'].iloc[:3].tolist() == ['chr4', 'chr4', 'chr4'] # liftover's first hit, the chr4 chain
+    assert lifted['pos_mm10'].iloc[:3].tolist() == [30000, 15000, 26000]
+    assert lifted['pos_mm10'].isna().iloc[3] # not aligned
+
+def test_matches_liftover(chain_path):
+    from liftover import get_lifter
+    converter = get_lifter(chain_path, one_based=True)
+
+    starts = np.arange(9000, 42000, 13)
+    probe_data, ref_data = positions(['chr4']*len(starts), starts)
+    lifted = get_pos_bulk(probe_data, ref_data, drop_undef=False, chain_path=chain_path)
+
+    for start, chr_mm10, pos_mm10 in zip(starts, lifted['chr_mm10'], lifted['pos_mm10']):
+        hits = converter['chr4'][int(start)]
+        if hits:
+            assert (chr_mm10, pos_mm10) == hits[0][:2]
+        else:
+            assert pd.isna(pos_mm10)